@@ -0,0 +1,104 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local control socket of the daemon.
+
+The AdminServer listens on a unix socket and reads one command per line.
+Every command is answered with a single line of JSON:
+
+  $ echo 'drain web' | nc -U /var/run/zk_watcher.sock
+  {"ok": true, "committed": {"web": true}}
+
+The commands are:
+
+  drain [service]    de-register the service (every service without one)
+                     right away, and keep it de-registered
+  undrain [service]  let the checks decide about it again, starting with an
+                     immediate check
+  check [service]    check the service right away, and publish the result
+  status [service]   the state of the service (or of every service)
+
+What the commands do is up to the handler (see WatcherDaemon._admin()). It
+is called with the command and its arguments, and returns a dict to send
+back, or raises AdminError.
+"""
+
+import json
+import logging
+import os
+import SocketServer
+import threading
+
+
+class AdminError(Exception):
+    """A command that cannot be carried out."""
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            words = line.split()
+            if not words:
+                continue
+            try:
+                response = self.server.handler(words[0], words[1:])
+                response['ok'] = True
+            except AdminError, e:
+                response = {'ok': False, 'error': str(e)}
+            except Exception, e:
+                self.server.log.exception('Command %r failed: %s' % (line, e))
+                response = {'ok': False, 'error': 'internal error: %s' % e}
+            self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+        # Anyone who can talk to us can take the host out of service
+        os.chmod(self.server_address, 0600)
+
+
+class AdminServer(object):
+    """Serves admin commands on a unix socket."""
+
+    LOGGER = 'WatcherDaemon.AdminServer'
+
+    def __init__(self, path, handler):
+        """Initialize the AdminServer object.
+
+        Args:
+            path: (String) path of the unix socket
+            handler: (Callable) called with each command and a list of its
+                     arguments. Returns the (dict) response."""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._path = path
+        self._server = _UnixServer(path, _Handler)
+        self._server.handler = handler
+        self._server.log = self.log
+
+    def start(self):
+        self.log.info('Serving admin commands on %s' % self._path)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  kwargs={'poll_interval': 5},
+                                  name='AdminServer')
+        thread.setDaemon(True)
+        thread.start()
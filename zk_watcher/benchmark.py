@@ -0,0 +1,286 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load simulation and benchmarks for the WatcherDaemon.
+
+Runs a WatcherDaemon against a MemoryRegistry with N synthetic config
+sections, and reports what it cost:
+
+  $ python -m zk_watcher.benchmark --sections 10,100,1000 --duration 30
+  $ python -m zk_watcher.benchmark --engine loop --check-time 0.05 \\
+        --failure-rate 10
+
+Each section runs a small shell script that sleeps for --check-time seconds
+and fails --failure-rate percent of the time. Every size is run in its own
+process, so that peak RSS and thread counts of one run do not leak into the
+next. Pass --json to get one JSON object per run instead of a table.
+
+"check cpu %" is the CPU time of the check commands. With the launcher
+engine it also includes the launcher process itself, which runs (and reaps)
+the commands on our behalf.
+"""
+
+# Otherwise "zk_watcher" below would be our zk_watcher.zk_watcher sibling
+from __future__ import absolute_import
+
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from zk_watcher import metrics
+from zk_watcher import zk_watcher as daemon
+from zk_watcher.launcher import LauncherEngine
+from zk_watcher.registry import MemoryRegistry
+
+CHECK_SCRIPT = """#!/bin/bash
+# usage: check.sh <seconds> <failure percent> <section>
+# (the section number keeps the daemon from sharing results between sections)
+sleep $1
+[ $((RANDOM % 100)) -ge $2 ]
+"""
+
+SECTION = """[bench-%(index)05d]
+cmd: %(script)s %(check_time)s %(failure_rate)s %(index)s
+refresh: %(refresh)s
+service_port: %(port)s
+service_hostname: bench.example.com
+zookeeper_path: /benchmark
+zookeeper_data: index=%(index)s
+
+"""
+
+COLUMNS = (
+    ('sections', 'sections', '%d'),
+    ('checks/s', 'check_rate', '%.1f'),
+    ('writes/s', 'write_rate', '%.1f'),
+    ('cpu %', 'cpu_percent', '%.1f'),
+    ('check cpu %', 'child_cpu_percent', '%.1f'),
+    ('rss MB', 'peak_rss_mb', '%.1f'),
+    ('threads', 'peak_threads', '%d'),
+    ('lag ms', 'lag_mean_ms', '%.1f'),
+    ('lag p99 ms', 'lag_p99_ms', '%.1f'),
+)
+
+usage = 'usage: %prog <options>'
+parser = optparse.OptionParser(usage=usage)
+parser.add_option('--sections', dest='sections', default='10,100,1000,10000',
+                  help='comma separated section counts to run '
+                       '(default: 10,100,1000,10000)')
+parser.add_option('--duration', dest='duration', type='float', default=30,
+                  help='seconds to run each size for (default: 30)')
+parser.add_option('--refresh', dest='refresh', type='int', default=10,
+                  help='refresh of every section (default: 10)')
+parser.add_option('--check-time', dest='check_time', type='float',
+                  default=0.01,
+                  help='seconds each check takes (default: 0.01)')
+parser.add_option('--failure-rate', dest='failure_rate', type='int',
+                  default=0,
+                  help='percentage of checks that fail (default: 0)')
+parser.add_option('--engine', dest='engine', type='choice',
+                  choices=['thread', 'loop', 'launcher'], default='thread',
+                  help='check engine to use (default: thread)')
+parser.add_option('--workers', dest='workers', type='int',
+                  default=daemon.WORKERS,
+                  help='scheduler worker threads (default: %d)' %
+                       daemon.WORKERS)
+parser.add_option('--max-checks', dest='max_checks', type='int',
+                  default=daemon.MAX_CHECKS,
+                  help='loop engine concurrency (default: %d)' %
+                       daemon.MAX_CHECKS)
+parser.add_option('--fast-start', action='store_true', dest='fast_start',
+                  default=False,
+                  help='run every first check immediately')
+parser.add_option('--json', action='store_true', dest='json', default=False,
+                  help='print one JSON object per run')
+parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
+                  default=False,
+                  help='show the daemon logs')
+parser.add_option('--run', dest='run', type='int', default=None,
+                  help='(internal) run a single size in this process')
+
+
+def percentile(hist, fraction):
+    """Returns the bucket bound under which fraction of a histogram falls."""
+    target = hist.count * fraction
+    cumulative = 0
+    for bound, count in zip(metrics.BUCKETS, hist.counts):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float('inf')
+
+
+def merge(series):
+    """Merges the per-service histograms of a metric into one."""
+    total = metrics.Histogram()
+    for hist in series.itervalues():
+        total.counts = [a + b for a, b in zip(total.counts, hist.counts)]
+        total.sum += hist.sum
+        total.count += hist.count
+    return total
+
+
+def process_cpu(pid):
+    """Returns the CPU seconds used by a live process and its reaped
+    children, from /proc/<pid>/stat."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return 0.0
+    # The command name may contain spaces, so count from the end of it:
+    # utime, stime, cutime and cstime are fields 14 to 17.
+    fields = stat.rsplit(')', 1)[1].split()
+    ticks = sum(int(field) for field in fields[11:15])
+    return float(ticks) / os.sysconf('SC_CLK_TCK')
+
+
+def write_config(path, options, sections):
+    script = os.path.join(path, 'check.sh')
+    with open(script, 'w') as f:
+        f.write(CHECK_SCRIPT)
+    os.chmod(script, 0755)
+
+    config = os.path.join(path, 'config.cfg')
+    with open(config, 'w') as f:
+        for index in xrange(sections):
+            f.write(SECTION % {
+                'index': index,
+                'script': script,
+                'check_time': options.check_time,
+                'failure_rate': options.failure_rate,
+                'refresh': options.refresh,
+                'port': 10000 + index,
+            })
+    return config
+
+
+def run(options, sections):
+    """Runs a single size in this process, and returns its results."""
+    path = tempfile.mkdtemp(prefix='zk_watcher_bench.')
+    try:
+        config = write_config(path, options, sections)
+        registry = MemoryRegistry()
+
+        start = time.time()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        watcher = daemon.WatcherDaemon(
+            server='memory',
+            config_file=config,
+            workers=options.workers,
+            engine=options.engine,
+            max_checks=options.max_checks,
+            fast_start=options.fast_start,
+            registry_class=lambda **kwargs: registry)
+
+        peak_threads = 0
+        while time.time() - start < options.duration:
+            time.sleep(0.5)
+            peak_threads = max(peak_threads, threading.active_count())
+
+        elapsed = time.time() - start
+        writes = len(registry.calls)
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        end_child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        # The launcher is still running, so its checks are not in our
+        # RUSAGE_CHILDREN yet. (One that died during the run is.)
+        launcher = isinstance(watcher._engine, LauncherEngine) and \
+            watcher._engine.pid()
+        launcher_cpu = process_cpu(launcher) if launcher else 0.0
+
+        # Stopped watchers drop their metrics, so collect them first
+        checks = merge(metrics.METRICS.get(
+            'zk_watcher_check_duration_seconds'))
+        lag = merge(metrics.METRICS.get('zk_watcher_schedule_lag_seconds'))
+        watcher.stop()
+        watcher.join(10)
+    finally:
+        shutil.rmtree(path)
+
+    cpu = (end_usage.ru_utime + end_usage.ru_stime -
+           usage.ru_utime - usage.ru_stime)
+    child_cpu = (end_child_usage.ru_utime + end_child_usage.ru_stime -
+                 child_usage.ru_utime - child_usage.ru_stime +
+                 launcher_cpu)
+
+    return {
+        'sections': sections,
+        'engine': options.engine,
+        'duration': elapsed,
+        'checks': checks.count,
+        'check_rate': checks.count / elapsed,
+        'writes': writes,
+        'write_rate': writes / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_percent': 100 * cpu / elapsed,
+        'child_cpu_seconds': child_cpu,
+        'child_cpu_percent': 100 * child_cpu / elapsed,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': end_usage.ru_maxrss / 1024.0,
+        'peak_threads': peak_threads,
+        'lag_mean_ms': 1000 * lag.sum / max(lag.count, 1),
+        'lag_p99_ms': 1000 * percentile(lag, 0.99),
+    }
+
+
+def main():
+    (options, args) = parser.parse_args()
+
+    if options.verbose:
+        daemon.setup_logger(verbose=True)
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    if options.run is not None:
+        print json.dumps(run(options, options.run))
+        # Don't wait for (or trip over) the daemon threads on our way out
+        sys.stdout.flush()
+        os._exit(0)
+
+    # Run every size in a fresh interpreter
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [package, env.get('PYTHONPATH')]))
+
+    if not options.json:
+        print '  '.join('%12s' % title for title, _, _ in COLUMNS)
+
+    for sections in options.sections.split(','):
+        command = [sys.executable, '-m', 'zk_watcher.benchmark',
+                   '--run', sections] + sys.argv[1:]
+        output = subprocess.Popen(command, env=env,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        result = json.loads(output.strip().splitlines()[-1])
+
+        if options.json:
+            print json.dumps(result)
+        else:
+            print '  '.join('%12s' % (fmt % result[key])
+                            for _, key, fmt in COLUMNS)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
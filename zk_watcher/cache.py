@@ -0,0 +1,211 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sharing check results between sections that run the same command.
+
+It is common for several sections to be gated on the same check, eg. one
+`pgrep nginx` for each port nginx listens on. The CheckCache sits in front of
+the check engine and, per distinct command:
+
+  * runs it at most once at a time; watchers asking for it while it runs
+    all get the result of that run,
+  * hands out its last result for a while after it finished.
+
+A result is kept for half of the smallest refresh among the watchers of the
+command, so that every watcher still sees a result at least as recent as if
+it had run the command itself. Watchers that want the output of the command
+(see dynamic.py) share runs among themselves only.
+
+A watcher that gives up on its run cancel()s it. A shared run is only killed
+once every watcher waiting for it has given up.
+"""
+
+import functools
+import logging
+import threading
+import time
+
+import metrics
+
+
+class _Entry(object):
+    """Subscribers and the latest result of one command."""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.waiters = None
+        self.keys = []
+        self.result = None
+        self.started = 0
+
+
+class _Fresh(object):
+    """A run of a command for a single watcher, outside of the cache."""
+
+
+class CheckCache(object):
+    """Collapses runs of identical check commands."""
+
+    LOGGER = 'WatcherDaemon.CheckCache'
+
+    def __init__(self, engine):
+        """Initialize the CheckCache object.
+
+        Args:
+            engine: (Engine) runs the commands"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._subscriptions = {}
+
+        # The run each watcher is waiting for: an _Entry or a _Fresh
+        self._runs = {}
+
+    def subscribe(self, key, command, refresh, output=False):
+        """Register a watcher of a command.
+
+        Args:
+            key: (Hashable) the watcher, eg. a ServiceWatcher
+            command: (String) its check command
+            refresh: (Float) the shortest interval it runs the command at
+            output: (Boolean) whether it runs it for its output"""
+        command = self._normalize(command, output)
+        with self._lock:
+            self._unsubscribe(key)
+            entry = self._entries.setdefault(command, _Entry())
+            entry.subscribers[key] = refresh
+            self._subscriptions[key] = command
+
+    def unsubscribe(self, key):
+        """Forget a watcher, eg. because it has been stopped."""
+        with self._lock:
+            self._unsubscribe(key)
+
+    def execute(self, command, service, timeout, callback, output=False,
+                fresh=False, key=None):
+        """Run a command, or share the result of another run of it.
+
+        Takes the same arguments as the engines' execute(). The callback may
+        be called right away, from the calling thread. With fresh, the
+        command is run anew in any case, eg. to confirm that a service just
+        went away.
+
+        Returns:
+            True if no new run was started for this call: the callback got
+            the result of another one (or is going to)."""
+        if fresh:
+            run = _Fresh()
+            if key is not None:
+                with self._lock:
+                    self._runs[key] = run
+            self._engine.execute(
+                command, service, timeout,
+                functools.partial(self._fresh_done, key, run, callback),
+                output=output, key=run)
+            return
+
+        normalized = self._normalize(command, output)
+        with self._lock:
+            entry = self._entries.setdefault(normalized, _Entry())
+
+            # Someone else is running it right now; wait for their result
+            if entry.waiters is not None:
+                entry.waiters.append(callback)
+                self._wait(entry, key)
+                metrics.inc('zk_watcher_check_cache_hits_total',
+                            service=service)
+                return True
+
+            ttl = min(entry.subscribers.values() or [0]) / 2.0
+            fresh = time.time() - entry.started < ttl
+            if entry.result is None or not fresh:
+                entry.waiters = [callback]
+                entry.keys = []
+                self._wait(entry, key)
+                entry.started = time.time()
+                callback = None
+            result = entry.result
+
+        if callback:
+            metrics.inc('zk_watcher_check_cache_hits_total', service=service)
+            callback(*result)
+            return True
+
+        self._engine.execute(command, service, timeout,
+                             functools.partial(self._done, normalized, entry),
+                             output=output, key=entry)
+
+    def cancel(self, key):
+        """Give up on the run the watcher key is waiting for.
+
+        The run is killed, unless other watchers are still waiting for it.
+        Either way, the callback of key is still called once it is over."""
+        with self._lock:
+            run = self._runs.pop(key, None)
+            if isinstance(run, _Entry):
+                run.keys.remove(key)
+                if run.keys:
+                    return
+        if run is not None:
+            self._engine.cancel(run)
+
+    def in_flight(self):
+        """Returns the checks running right now (see the engines)."""
+        return self._engine.in_flight()
+
+    def _wait(self, entry, key):
+        """Must be called with self._lock held."""
+        # Waiters that can't cancel keep the run alive
+        entry.keys.append(key)
+        if key is not None:
+            self._runs[key] = entry
+
+    def _fresh_done(self, key, run, callback, *result):
+        with self._lock:
+            if self._runs.get(key) is run:
+                del self._runs[key]
+        callback(*result)
+
+    def _done(self, command, entry, *result):
+        with self._lock:
+            entry.result = result
+            waiters = entry.waiters
+            entry.waiters = None
+            for key in entry.keys:
+                if self._runs.get(key) is entry:
+                    del self._runs[key]
+            entry.keys = []
+            if not entry.subscribers and self._entries.get(command) is entry:
+                del self._entries[command]
+
+        for callback in waiters:
+            try:
+                callback(*result)
+            except Exception, e:
+                self.log.exception('Check callback failed: %s' % e)
+
+    def _unsubscribe(self, key):
+        """Must be called with self._lock held."""
+        command = self._subscriptions.pop(key, None)
+        entry = self._entries.get(command)
+        if entry is None:
+            return
+        entry.subscribers.pop(key, None)
+        if not entry.subscribers and entry.waiters is None:
+            del self._entries[command]
+
+    def _normalize(self, command, output):
+        return (' '.join(command.split()), output)
@@ -0,0 +1,293 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Native service checks that run inside the watcher process.
+
+Most service checks only ask whether a port accepts connections or whether
+an HTTP endpoint answers. Running those as shell commands costs a fork and
+exec of the daemon for every check. These checks do the same work in
+process, and return an exit-code style result (0 for healthy) so they can be
+used anywhere a Command can:
+
+  [memcache]
+  check: tcp
+  check_timeout: 2
+  service_port: 11211
+  zookeeper_path: /services/prod-uswest1-mc
+"""
+
+import errno
+import httplib
+import logging
+import os
+import select
+import socket
+import time
+import urlparse
+
+# Default timeout (seconds) for a single native check
+TIMEOUT = 5
+
+
+class Check(object):
+    """Base class for the native checks."""
+
+    LOGGER = 'WatcherDaemon.Check'
+
+    def __init__(self, timeout=TIMEOUT):
+        self._timeout = float(timeout)
+        self.log = logging.getLogger('%s.%s' % (self.LOGGER,
+                                                self.__class__.__name__))
+
+    def run(self):
+        """Runs the check. Returns 0 if healthy, 1 otherwise."""
+        try:
+            if self._check():
+                return 0
+        except (socket.error, httplib.HTTPException, IOError, ValueError), e:
+            self.log.debug('[%s] failed: %s', self, e)
+        return 1
+
+    def _check(self):
+        raise NotImplementedError()
+
+
+class TCPCheck(Check):
+    """Healthy if host:port accepts a TCP connection."""
+
+    def __init__(self, host, port, timeout=TIMEOUT):
+        super(TCPCheck, self).__init__(timeout)
+        self._host = host
+        self._port = int(port)
+
+    def __str__(self):
+        return 'tcp://%s:%s' % (self._host, self._port)
+
+    def _check(self):
+        sock = socket.create_connection((self._host, self._port),
+                                        self._timeout)
+        sock.close()
+        return True
+
+
+class UnixCheck(Check):
+    """Healthy if the unix socket at path accepts a connection."""
+
+    def __init__(self, path, timeout=TIMEOUT):
+        super(UnixCheck, self).__init__(timeout)
+        self._path = path
+
+    def __str__(self):
+        return 'unix://%s' % self._path
+
+    def _check(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self._timeout)
+            sock.connect(self._path)
+        finally:
+            sock.close()
+        return True
+
+
+class HTTPCheck(Check):
+    """Healthy if a GET of url returns a 2xx status."""
+
+    def __init__(self, url, timeout=TIMEOUT):
+        super(HTTPCheck, self).__init__(timeout)
+        self._url = url
+
+    def __str__(self):
+        return self._url
+
+    def _check(self):
+        url = urlparse.urlsplit(self._url)
+        if url.scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+
+        path = url.path or '/'
+        if url.query:
+            path = '%s?%s' % (path, url.query)
+
+        conn = conn_class(url.hostname, url.port, timeout=self._timeout)
+        try:
+            conn.request('GET', path)
+            status = conn.getresponse().status
+        finally:
+            conn.close()
+
+        self.log.debug('[%s] returned status %s', self, status)
+        return 200 <= status < 300
+
+
+class PidfileCheck(Check):
+    """Healthy if the process named in a pidfile is alive."""
+
+    def __init__(self, path, timeout=TIMEOUT):
+        super(PidfileCheck, self).__init__(timeout)
+        self._path = path
+
+    def __str__(self):
+        return 'pidfile://%s' % self._path
+
+    def _check(self):
+        with open(self._path) as f:
+            pid = int(f.read().strip())
+
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            # EPERM means the process exists, we just can't signal it
+            if e.errno != errno.EPERM:
+                return False
+        return True
+
+
+def run_all(checks):
+    """Runs several checks in one pass, eg. those of a multi-instance section.
+
+    All of the TCP checks are done in a single sweep of non-blocking
+    connects, and checks that are identical (like the same pidfile for
+    every instance) are only run once.
+
+    Args:
+        checks: (List) Check objects
+
+    Returns:
+        A list with the result of each check."""
+    results = {}
+    tcp = []
+    for check in checks:
+        if isinstance(check, TCPCheck):
+            tcp.append(check)
+        elif str(check) not in results:
+            results[str(check)] = check.run()
+
+    results.update(_sweep(tcp))
+    return [results[str(check)] for check in checks]
+
+
+def _sweep(checks):
+    """Connects to every TCPCheck at once.
+
+    Like socket.create_connection(), which a single TCPCheck uses, every
+    address of the host is tried in turn until one accepts the connection:
+    eg. both ::1 and 127.0.0.1 for localhost.
+
+    Returns:
+        A dict of str(check) -> result."""
+    results = {}
+    pending = {}
+    addresses = {}
+    deadline = time.time() + max([c._timeout for c in checks] or [0])
+
+    for check in checks:
+        if str(check) in results or \
+                str(check) in [name for name, _, _ in pending.values()]:
+            continue
+        try:
+            if check._host not in addresses:
+                addresses[check._host] = socket.getaddrinfo(
+                    check._host, None, 0, socket.SOCK_STREAM)
+        except socket.error, e:
+            check.log.debug('[%s] failed: %s' % (check, e))
+            results[str(check)] = 1
+            continue
+        _connect(str(check), check._port, list(addresses[check._host]),
+                 results, pending)
+
+    while pending:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            _, ready, _ = select.select([], pending.keys(), [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for sock in ready:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            name, port, remaining = pending.pop(sock)
+            sock.close()
+            if err == 0:
+                results[name] = 0
+            else:
+                _connect(name, port, remaining, results, pending)
+
+    # Whatever did not connect in time failed
+    for sock, (name, _, _) in pending.iteritems():
+        results[name] = 1
+        sock.close()
+    return results
+
+
+def _connect(name, port, remaining, results, pending):
+    """Starts a non-blocking connect to the first of the remaining addresses
+    (from getaddrinfo()) that does not fail right away.
+
+    The socket goes into pending, along with the addresses left to try if it
+    fails. If it connects right away, or none of the addresses will do, the
+    result goes into results instead."""
+    while remaining:
+        family, _, _, _, address = remaining.pop(0)
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+        except socket.error:
+            continue
+        sock.setblocking(0)
+        err = sock.connect_ex((address[0], port) + address[2:])
+        if err in (0, errno.EISCONN):
+            results[name] = 0
+            sock.close()
+            return
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = (name, port, remaining)
+            return
+        sock.close()
+    results[name] = 1
+
+
+def get_check(check_type, config, service_port):
+    """Builds a native check from the options of a config section.
+
+    Args:
+        check_type: (String) one of tcp, http, unix or pidfile
+        config: (Dict) options of the config section
+        service_port: (String) port the service is registered with
+
+    Returns:
+        A Check object.
+
+    Raises:
+        ValueError if check_type is not a known check."""
+
+    timeout = config.get('check_timeout', TIMEOUT)
+
+    if check_type == 'tcp':
+        return TCPCheck(host=config.get('check_host', 'localhost'),
+                        port=config.get('check_port', service_port),
+                        timeout=timeout)
+    if check_type == 'http':
+        url = config.get('check_url',
+                         'http://localhost:%s/' % service_port)
+        return HTTPCheck(url=url, timeout=timeout)
+    if check_type == 'unix':
+        return UnixCheck(path=config['check_socket'], timeout=timeout)
+    if check_type == 'pidfile':
+        return PidfileCheck(path=config['check_pidfile'], timeout=timeout)
+
+    raise ValueError('Unknown check type: %s' % check_type)
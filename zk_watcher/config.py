@@ -0,0 +1,263 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental loading and watching of the config files.
+
+The config is read from the main config file (/etc/zk/config.cfg) plus every
+*.cfg file in a config directory (/etc/zk/conf.d). The ConfigLoader only
+re-parses files whose contents changed since the last load, and hashes every
+section so the WatcherDaemon only has to touch the sections that changed.
+
+The ConfigWatcher uses inotify to notice when any of those files change.
+"""
+
+import ConfigParser
+import ctypes
+import ctypes.util
+import errno
+import glob
+import hashlib
+import logging
+import os
+import select
+import struct
+import threading
+import StringIO
+
+
+class _File(object):
+    """What we know about a single config file from its last load."""
+
+    def __init__(self, stat, digest, sections, auth):
+        self.stat = stat
+        self.digest = digest
+        self.sections = sections
+        self.auth = auth
+
+
+class ConfigLoader(object):
+    """Reads the config files, re-parsing only the ones that changed."""
+
+    LOGGER = 'WatcherDaemon.ConfigLoader'
+
+    def __init__(self, config_file, config_dir=None):
+        """Initialize the ConfigLoader object.
+
+        Args:
+            config_file: (String) path of the main config file
+            config_dir: (String) directory of additional *.cfg files"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self.config_file = config_file
+        self.config_dir = config_dir
+        self._files = {}
+
+        # Filled in by load()
+        self.user = None
+        self.password = None
+
+    def files(self):
+        """Returns the paths of all of our config files, in load order."""
+        files = [self.config_file]
+        if self.config_dir:
+            files.extend(sorted(glob.glob(os.path.join(self.config_dir,
+                                                       '*.cfg'))))
+        return files
+
+    def load(self):
+        """Loads the config.
+
+        Returns:
+            A dict of service name -> (digest, options) for every section,
+            where options is a dict of the section's settings and digest a
+            hash of them."""
+        sections = {}
+        files = {}
+        self.user = None
+        self.password = None
+
+        for path in self.files():
+            config = self._load_file(path)
+            if config is None:
+                continue
+            files[path] = config
+
+            for service, section in config.sections.iteritems():
+                if service in sections:
+                    self.log.warning('Section [%s] in %s overrides an '
+                                     'earlier one' % (service, path))
+                sections[service] = section
+
+            # Only the main config file may carry credentials
+            if path == self.config_file and config.auth:
+                self.user, self.password = config.auth
+
+        self._files = files
+        return sections
+
+    def _load_file(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        # Cheap check first: if the file looks untouched, we're done.
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        old = self._files.get(path)
+        if old and old.stat == key:
+            return old
+
+        with open(path) as f:
+            content = f.read()
+        digest = hashlib.md5(content).hexdigest()
+        if old and old.digest == digest:
+            old.stat = key
+            return old
+
+        self.log.debug('Parsing %s' % path)
+        config = ConfigParser.ConfigParser()
+        config.readfp(StringIO.StringIO(content), path)
+
+        # Check if auth data was supplied. If it is, read it in and then
+        # remove it from our configuration object so its not used anywhere
+        # else.
+        try:
+            auth = (config.get('auth', 'user'), config.get('auth', 'password'))
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            auth = None
+        config.remove_section('auth')
+
+        sections = {}
+        for service in config.sections():
+            options = dict(config.items(service))
+            digest = hashlib.md5(repr(sorted(options.items()))).hexdigest()
+            sections[service] = (digest, options)
+
+        return _File(key, digest, sections, auth)
+
+
+class ConfigWatcher(object):
+    """Calls a callback when any of our config files change.
+
+    Uses inotify on the directories holding the config files, so that files
+    replaced by a rename (as most editors and config management tools do)
+    are noticed as well."""
+
+    LOGGER = 'WatcherDaemon.ConfigWatcher'
+
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 04000
+    EVENT = struct.Struct('iIII')
+
+    # Wait this long (seconds) after a change for more changes to come in
+    SETTLE = 0.5
+
+    def __init__(self, loader, callback):
+        """Initialize the ConfigWatcher object.
+
+        Args:
+            loader: (ConfigLoader) tells us which files to watch
+            callback: (Callable) called after the config has changed
+
+        Raises:
+            OSError if inotify is not available."""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._loader = loader
+        self._callback = callback
+        self._dirs = {}
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                self.IN_CREATE | self.IN_DELETE | self.IN_MODIFY)
+        config_file = os.path.abspath(loader.config_file)
+        watches = [(os.path.dirname(config_file),
+                    os.path.basename(config_file))]
+        if loader.config_dir:
+            watches.append((os.path.abspath(loader.config_dir), None))
+
+        for path, name in watches:
+            wd = libc.inotify_add_watch(self._fd, path, mask)
+            if wd < 0:
+                self.log.warning('Cannot watch %s for changes' % path)
+                continue
+            self._dirs[wd] = name
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='ConfigWatcher')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            select.select([self._fd], [], [])
+            if not self._relevant(self._read()):
+                continue
+
+            # Editors and config management often touch several files in a
+            # row. Wait until things settle down, then reload once.
+            while select.select([self._fd], [], [], self.SETTLE)[0]:
+                self._read()
+
+            self.log.info('Config files changed, reloading')
+            try:
+                self._callback()
+            except Exception, e:
+                self.log.exception('Config reload failed: %s' % e)
+
+    def _read(self):
+        """Returns the (wd, name) of all of the pending events."""
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, name))
+        return events
+
+    def _relevant(self, events):
+        for wd, name in events:
+            if wd not in self._dirs:
+                continue
+            # In the main config file's directory we only care about the
+            # config file itself. In the config dir, about any *.cfg file.
+            wanted = self._dirs[wd]
+            if wanted is None and name.endswith('.cfg'):
+                return True
+            if name == wanted:
+                return True
+        return False
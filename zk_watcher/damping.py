@@ -0,0 +1,124 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rise/fall thresholds and flap damping for service state.
+
+Every change of a registration fans out watch events to every client of the
+path, so a service that alternates between passing and failing checks should
+not flap its node. A StateFilter turns raw check results into the state we
+publish:
+
+  * the service only goes up after `rise` passing checks in a row, and only
+    goes down after `fall` failing checks in a row (like HAProxy),
+  * optionally, each state change adds a penalty that decays exponentially
+    with a half-life (like BGP route flap damping). Once the penalty reaches
+    SUPPRESS the service is held down until it decays below REUSE.
+"""
+
+import logging
+import time
+
+# Flap damping penalty per state change, and the suppress/reuse thresholds
+PENALTY = 1000
+SUPPRESS = 2000
+REUSE = 750
+
+
+class StateFilter(object):
+    """Filters raw check results into a stable published state."""
+
+    LOGGER = 'WatcherDaemon.StateFilter'
+
+    def __init__(self, service, rise=1, fall=1, half_life=0):
+        self.log = logging.getLogger('%s.%s' % (self.LOGGER, service))
+        self._state = None
+        self._streak = 0
+        self._last_result = None
+        self._penalty = 0.0
+        self._decayed = time.time()
+        self._suppressed = False
+        self.configure(rise, fall, half_life)
+
+    def configure(self, rise=1, fall=1, half_life=0):
+        """Update the thresholds without losing the current state.
+
+        Args:
+            rise: (Int) passing checks in a row needed to go up
+            fall: (Int) failing checks in a row needed to go down
+            half_life: (Float) flap penalty half-life in seconds, 0 disables
+                       flap damping"""
+        self._rise = max(int(rise), 1)
+        self._fall = max(int(fall), 1)
+        self._half_life = float(half_life)
+        if not self._half_life:
+            self._penalty = 0.0
+            self._suppressed = False
+
+    def assume(self, state):
+        """Start over from a state we did not observe ourselves.
+
+        Args:
+            state: (Boolean) eg. the state restored from a snapshot, or None
+                   to take the next check result as is"""
+        self._state = state
+        self._last_result = None
+        self._streak = 0
+
+    def update(self, result):
+        """Record a check result and return the state to publish.
+
+        Args:
+            result: (Boolean) whether the check passed
+
+        Returns:
+            True if the service should be registered."""
+        if result == self._last_result:
+            self._streak += 1
+        else:
+            self._last_result = result
+            self._streak = 1
+
+        if self._state is None:
+            # Take the very first result as is, so that we register right
+            # away on startup.
+            self._state = result
+        elif result != self._state:
+            needed = self._rise if result else self._fall
+            if self._streak >= needed:
+                self._state = result
+                self._flapped()
+
+        self._decay()
+        return self._state and not self._suppressed
+
+    def _flapped(self):
+        if not self._half_life:
+            return
+
+        self._decay()
+        self._penalty += PENALTY
+        if not self._suppressed and self._penalty >= SUPPRESS:
+            self._suppressed = True
+            self.log.warning('Service is flapping (penalty %d), holding it '
+                             'down' % self._penalty)
+
+    def _decay(self):
+        now = time.time()
+        if self._half_life and self._penalty:
+            self._penalty *= 0.5 ** ((now - self._decayed) / self._half_life)
+            if self._suppressed and self._penalty < REUSE:
+                self._suppressed = False
+                self.log.warning('Service has stopped flapping (penalty %d)'
+                                 % self._penalty)
+        self._decayed = now
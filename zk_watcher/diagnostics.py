@@ -0,0 +1,261 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runtime diagnostics of the daemon.
+
+Sending the daemon SIGUSR1 dumps its thread stacks, the timings of every
+ServiceWatcher and the checks currently running (see
+WatcherDaemon._dump()). The helpers for that live here:
+
+  * TimingStats keeps the last value, a moving average and the p99 of a
+    recent window of timings,
+  * thread_stacks() formats the stack of every thread,
+  * the Sampler samples the stacks of all threads for a number of seconds,
+    and writes how often each one was seen in the "folded" format that
+    flamegraph.pl and speedscope read.
+
+The StartupTimer breaks down how long it took the daemon to get from being
+started to having every service checked and published. The StartupTracker
+tells it when every service has got there.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Number of timings TimingStats computes its percentiles over, and the
+# weight of each new timing in its moving average
+WINDOW = 128
+ALPHA = 0.2
+
+
+class TimingStats(object):
+    """Summary of a series of timings."""
+
+    def __init__(self):
+        self.last = None
+        self.average = None
+        self._window = collections.deque(maxlen=WINDOW)
+
+    def record(self, value):
+        self.last = value
+        if self.average is None:
+            self.average = value
+        else:
+            self.average += ALPHA * (value - self.average)
+        self._window.append(value)
+
+    def percentile(self, fraction):
+        """Returns the given percentile of the recent timings, or None."""
+        if not self._window:
+            return None
+        values = sorted(self._window)
+        return values[min(int(len(values) * fraction), len(values) - 1)]
+
+    def format(self):
+        if self.last is None:
+            return '-'
+        return 'last %.3fs avg %.3fs p99 %.3fs' % (
+            self.last, self.average, self.percentile(0.99))
+
+
+def thread_stacks():
+    """Returns the formatted stacks of all threads."""
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append('Thread %s (%s):' % (names.get(ident, '?'), ident))
+        lines.extend(line.rstrip()
+                     for line in traceback.format_stack(frame))
+    return lines
+
+
+def process_age():
+    """Returns the number of seconds since this process was started.
+
+    None if that cannot be told (it takes /proc)."""
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError, ValueError):
+        return None
+    # The command name (field 2) may contain spaces; skip past it
+    started = int(stat.rsplit(')', 1)[1].split()[19])
+    return max(uptime - started / float(os.sysconf('SC_CLK_TCK')), 0)
+
+
+class StartupTimer(object):
+    """Milestones of our startup, in seconds since the process started.
+
+    Milestones rather than phases, since some of them overlap: eg. the
+    ZooKeeper session is set up while the first checks are running."""
+
+    def __init__(self):
+        self._start = time.time() - (process_age() or 0)
+        self.milestones = []
+
+    def mark(self, name):
+        """Record that we got to the named milestone just now."""
+        elapsed = time.time() - self._start
+        self.milestones.append((name, elapsed))
+        return elapsed
+
+    def format(self):
+        return ', '.join('%s %.3fs' % milestone
+                         for milestone in self.milestones)
+
+
+class StartupTracker(object):
+    """Tells when every watcher has got to a milestone of our startup.
+
+    Watchers add() themselves as they are set up, and report each milestone
+    with reached(), which costs next to nothing once startup is over. The
+    watchers being set up may well report in before the last of them has
+    been added, so a milestone only counts as reached after arm()."""
+
+    def __init__(self, milestones, callback):
+        """Initialize the StartupTracker object.
+
+        Args:
+            milestones: (List) names of the milestones
+            callback: (Callable) called with the name of each milestone,
+                      once every watcher has reached it. The calls are
+                      made one at a time, in the order the milestones are
+                      reached."""
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._waiting = collections.OrderedDict(
+            (name, set()) for name in milestones)
+        self._armed = False
+        self.done = False
+
+    def add(self, watcher):
+        with self._lock:
+            if self.done:
+                return
+            for waiting in self._waiting.itervalues():
+                waiting.add(watcher)
+
+    def reached(self, watcher, milestone):
+        if self.done:
+            return
+        with self._lock:
+            waiting = self._waiting.get(milestone)
+            if waiting is not None:
+                waiting.discard(watcher)
+            self._check()
+
+    def forget(self, watcher):
+        """Stop waiting for a watcher, eg. because it has been stopped."""
+        if self.done:
+            return
+        with self._lock:
+            for waiting in self._waiting.itervalues():
+                waiting.discard(watcher)
+            self._check()
+
+    def arm(self):
+        """Every watcher has been added."""
+        with self._lock:
+            self._armed = True
+            self._check()
+
+    def _check(self):
+        """Calls back for the milestones reached just now.
+
+        Must be called with self._lock held."""
+        if not self._armed:
+            return
+        reached = [name for name, waiting in self._waiting.iteritems()
+                   if not waiting]
+        for name in reached:
+            del self._waiting[name]
+        self.done = not self._waiting
+        for name in reached:
+            self._callback(name)
+
+
+class Sampler(object):
+    """Statistical profiler of every thread of the daemon.
+
+    cProfile only sees the thread that enabled it, while most of our work
+    happens in the Scheduler's workers. Sampling the stacks of all threads
+    every few milliseconds instead costs little and shows all of them."""
+
+    LOGGER = 'WatcherDaemon.Sampler'
+
+    # Seconds between samples
+    INTERVAL = 0.005
+
+    def __init__(self, duration, path):
+        """Initialize the Sampler object.
+
+        Args:
+            duration: (Float) seconds to sample for
+            path: (String) where to write the profile"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._duration = duration
+        self._path = path
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='Sampler')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self):
+        self.log.info('Profiling for %ss' % self._duration)
+        me = threading.current_thread().ident
+        names = {}
+        counts = collections.defaultdict(int)
+        samples = 0
+
+        end = time.time() + self._duration
+        while time.time() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = dict((t.ident, t.name)
+                                 for t in threading.enumerate())
+                counts[self._fold(names.get(ident, 'thread'), frame)] += 1
+            samples += 1
+            time.sleep(self.INTERVAL)
+
+        try:
+            with open(self._path, 'w') as f:
+                for stack, count in sorted(counts.iteritems()):
+                    f.write('%s %d\n' % (stack, count))
+        except IOError, e:
+            self.log.error('Could not write profile %s: %s' % (self._path, e))
+            return
+        self.log.info('Wrote profile of %s samples to %s' %
+                      (samples, self._path))
+
+    def _fold(self, name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(name.split('-worker-')[0])
+        return ';'.join(reversed(stack))
@@ -0,0 +1,125 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Registration data reported by the check command itself.
+
+With `dynamic_data` enabled, the output of a section's check command is
+parsed and merged into the data of its node, so that clients can route by
+live load:
+
+  $ /usr/local/bin/check_nginx
+  {"connections": 112, "weight": 80}
+
+or one key=value pair per line (or comma separated):
+
+  connections=112
+  weight=80
+
+Only the first MAX_OUTPUT bytes of the output are read. Every change of the
+node fans out to all of the clients watching its path, so a DataFilter keeps
+small fluctuations and rapid changes from turning into a write storm.
+"""
+
+import json
+import time
+
+# Most bytes of check output we look at
+MAX_OUTPUT = 4096
+
+
+def parse_output(output):
+    """Parses check output into a dict of fields.
+
+    Args:
+        output: (String) a JSON object, or key=value pairs separated by
+                newlines or commas
+
+    Returns:
+        A dict, empty if nothing could be parsed. Numeric values are
+        converted to numbers."""
+    output = output.strip()
+    try:
+        fields = json.loads(output)
+        if isinstance(fields, dict):
+            return fields
+        return {}
+    except ValueError:
+        pass
+
+    fields = {}
+    for pair in output.replace(',', '\n').splitlines():
+        key, sep, value = pair.partition('=')
+        if not sep or not key.strip():
+            continue
+        fields[key.strip()] = _number(value.strip())
+    return fields
+
+
+def _number(value):
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+class DataFilter(object):
+    """Decides which reported fields are worth publishing."""
+
+    def __init__(self, interval=30, threshold=10):
+        """Initialize the DataFilter object.
+
+        Args:
+            interval: (Float) at most one update of the fields every this
+                      many seconds
+            threshold: (Float) percentage by which a number has to change
+                       to count as a change"""
+        self.fields = {}
+        self._published = 0
+        self.configure(interval, threshold)
+
+    def configure(self, interval=30, threshold=10):
+        self._interval = float(interval)
+        self._threshold = float(threshold) / 100
+
+    def update(self, fields):
+        """Record freshly reported fields.
+
+        Returns:
+            True if self.fields (the fields to publish) changed."""
+        now = time.time()
+        if now - self._published < self._interval:
+            return False
+        if not self._changed(fields):
+            return False
+
+        self.fields = fields
+        self._published = now
+        return True
+
+    def _changed(self, fields):
+        if set(fields) != set(self.fields):
+            return True
+
+        for key, value in fields.iteritems():
+            old = self.fields[key]
+            numbers = (int, long, float)
+            if isinstance(value, numbers) and isinstance(old, numbers) and \
+                    not isinstance(value, bool):
+                if abs(value - old) > abs(old) * self._threshold:
+                    return True
+            elif value != old:
+                return True
+        return False
@@ -0,0 +1,306 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Event-loop engine for running service check commands.
+
+The default engine runs each check in a Scheduler worker, and Command.run
+spends a helper thread on every check blocked in communicate(). The
+LoopEngine instead starts every check from a single thread that multiplexes
+all of the running processes with select():
+
+  * each check runs in its own process group, which is killed as a whole
+    once the check exceeds its timeout, or is cancelled,
+  * at most `concurrency` checks run at once; the rest wait their turn,
+  * results are handed back to the Scheduler's workers, so the loop itself
+    never blocks on ZooKeeper.
+"""
+
+import collections
+import errno
+import fcntl
+import functools
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+import metrics
+from dynamic import MAX_OUTPUT
+
+
+class _Job(object):
+    """A single queued or running check."""
+
+    def __init__(self, command, service, timeout, callback, output=False,
+                 key=None):
+        self.command = command
+        self.service = service
+        self.timeout = timeout
+        self.callback = callback
+        self.output = '' if output else None
+        self.key = key
+        self.cancelled = False
+        self.process = None
+        self.started = None
+        self.deadline = None
+        self.fd = None
+
+
+class LoopEngine(object):
+    """Runs check commands from a single select() loop thread."""
+
+    LOGGER = 'WatcherDaemon.LoopEngine'
+
+    # While checks are running we wake up at least this often (seconds) to
+    # reap children whose stdout is still held open by a grandchild.
+    REAP_INTERVAL = 1
+
+    def __init__(self, scheduler, concurrency=32, limits=None):
+        """Initialize the LoopEngine object.
+
+        Args:
+            scheduler: (Scheduler) runs the result callbacks
+            concurrency: (Int) maximum number of checks running at once
+            limits: (Limits) applied to every check process"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._scheduler = scheduler
+        self._concurrency = int(concurrency)
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._jobs = []
+        self._keys = {}
+        self._stopped = False
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+        self._devnull = open(os.devnull)
+
+    def start(self):
+        """Start the loop thread."""
+        self._thread = threading.Thread(target=self._loop, name='LoopEngine')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the loop thread, killing any running checks."""
+        with self._lock:
+            self._stopped = True
+        self._wake()
+
+    def join(self):
+        """Wait for the loop thread to exit after stop()."""
+        self._thread.join()
+
+    def execute(self, command, service, timeout, callback, output=False,
+                key=None):
+        """Queue up a check. Returns immediately.
+
+        Args:
+            command: (String) command to execute
+            service: (String) service name, used for logging
+            timeout: (Int) seconds before the check is killed
+            callback: (Callable) called with the exit code of the command,
+                      and with its output too if output is set
+            output: (Boolean) keep the first MAX_OUTPUT bytes of stdout
+            key: (Hashable) identifies the check to cancel()"""
+        job = _Job(command, service, timeout, callback, output, key)
+        with self._lock:
+            self._pending.append(job)
+            if key is not None:
+                self._keys[key] = job
+        self._wake()
+
+    def cancel(self, key):
+        """Kill the last check started with key, if it is still running.
+
+        Its callback is still called, with the exit code of the killed
+        command (or 1 if it never got to run)."""
+        with self._lock:
+            job = self._keys.pop(key, None)
+            if job is None:
+                return
+            job.cancelled = True
+        self._wake()
+
+    def in_flight(self):
+        """Returns the checks running right now, for diagnostics.
+
+        Returns:
+            A list of (service, command, pid, seconds running) tuples."""
+        now = time.time()
+        return [(job.service, job.command, job.process.pid, now - job.started)
+                for job in list(self._jobs)]
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    break
+                start = []
+                while self._pending and \
+                        len(self._jobs) + len(start) < self._concurrency:
+                    job = self._pending.popleft()
+                    if job.cancelled:
+                        self._forget(job)
+                        self._callback(job, 1)
+                    else:
+                        start.append(job)
+
+            for job in start:
+                self._launch(job)
+
+            now = time.time()
+            timeout = None
+            for job in list(self._jobs):
+                if job.process.poll() is not None:
+                    self._finish(job)
+                elif job.cancelled:
+                    self.log.debug('[%s] cancelled, terminating.',
+                                   job.command)
+                    self._kill(job)
+                    self._finish(job)
+                elif job.deadline <= now:
+                    self.log.debug('[%s] taking too long to respond, '
+                                   'terminating.', job.command)
+                    metrics.inc('zk_watcher_check_timeouts_total',
+                                service=job.service)
+                    self._kill(job)
+                    self._finish(job)
+                else:
+                    wait = min(job.deadline - now, self.REAP_INTERVAL)
+                    if job.fd is None:
+                        # stdout is closed but the child has not exited
+                        # yet, check back shortly.
+                        wait = min(wait, 0.05)
+                    if timeout is None or wait < timeout:
+                        timeout = wait
+
+            fds = [self._wake_r] + [j.fd for j in self._jobs
+                                    if j.fd is not None]
+            try:
+                ready, _, _ = select.select(fds, [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            for fd in ready:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                else:
+                    self._read(fd)
+
+        # We're exiting. Don't leave any of our checks behind.
+        for job in self._jobs:
+            self._kill(job)
+
+    def _launch(self, job):
+        self.log.debug('[%s] started...', job.command)
+        # Each check gets its own process group so that a timeout kills
+        # anything the command itself has spawned as well.
+        try:
+            job.process = subprocess.Popen(
+                job.command.split(' '),
+                shell=False,
+                stdout=subprocess.PIPE,
+                stderr=None,
+                stdin=self._devnull,
+                close_fds=True,
+                preexec_fn=self._preexec)
+        except Exception, e:
+            # With a preexec_fn, whatever it raised in the child is raised
+            # here again, eg. an IOError from Limits.apply()
+            self.log.warn('Failed to run: %s', e)
+            with self._lock:
+                self._forget(job)
+            self._callback(job, 1)
+            return
+
+        job.fd = job.process.stdout.fileno()
+        flags = fcntl.fcntl(job.fd, fcntl.F_GETFL)
+        fcntl.fcntl(job.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        job.started = time.time()
+        job.deadline = job.started + job.timeout
+        self._jobs.append(job)
+
+    def _preexec(self):
+        os.setsid()
+        if self._limits:
+            self._limits.apply()
+
+    def _read(self, fd):
+        """Drain the output of a check, keeping what we were asked for."""
+        for job in self._jobs:
+            if job.fd == fd:
+                break
+        else:
+            return
+
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+
+        if not data:
+            self._close(job)
+        elif job.output is not None and len(job.output) < MAX_OUTPUT:
+            job.output += data[:MAX_OUTPUT - len(job.output)]
+
+    def _close(self, job):
+        if job.fd is not None:
+            job.process.stdout.close()
+            job.fd = None
+
+    def _kill(self, job):
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        job.process.wait()
+
+    def _finish(self, job):
+        # Pick up whatever output the check left in the pipe on its way out
+        if job.fd is not None and job.output is not None:
+            self._read(job.fd)
+        self._close(job)
+        self._jobs.remove(job)
+        with self._lock:
+            self._forget(job)
+        self.log.debug('[%s] finished... returning %s', job.command,
+                       job.process.returncode)
+        self._callback(job, job.process.returncode)
+
+    def _forget(self, job):
+        """Must be called with self._lock held."""
+        if job.key is not None and self._keys.get(job.key) is job:
+            del self._keys[job.key]
+
+    def _callback(self, job, ret):
+        if job.output is not None:
+            callback = functools.partial(job.callback, ret, job.output)
+        else:
+            callback = functools.partial(job.callback, ret)
+        self._scheduler.submit(callback)
@@ -0,0 +1,277 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Launcher process for running check commands outside of the daemon.
+
+Every check the other engines run forks the daemon itself, with its Kazoo
+client, threads and memory, only to exec the check right away. The
+LauncherEngine instead starts one small helper process at boot (a fresh
+interpreter, not a fork of the daemon) and sends it check requests over a
+pipe. The launcher runs them with a LoopEngine of its own and answers with
+their exit codes and timings, so the daemon never forks in its hot path.
+
+The protocol is one JSON object per line. Requests:
+
+  {"id": 1, "cmd": "pgrep memcached", "timeout": 90, "output": false}
+
+Responses:
+
+  {"id": 1, "ret": 0, "time": 0.0042, "timeout": false}
+
+With "output" set, the response carries the first MAX_OUTPUT bytes the
+command wrote to stdout in "output" as well. A running check is killed with
+
+  {"cancel": 1}
+
+and answered as usual, with the exit code of the killed command.
+
+The launcher exits when its stdin is closed.
+"""
+
+import functools
+import itertools
+import json
+import logging
+import optparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+from engine import LoopEngine
+from limits import Limits
+
+
+class LauncherEngine(object):
+    """Runs check commands through a separate launcher process."""
+
+    LOGGER = 'WatcherDaemon.LauncherEngine'
+
+    def __init__(self, scheduler, concurrency=32, limits=None):
+        """Initialize the LauncherEngine object.
+
+        Args:
+            scheduler: (Scheduler) runs the result callbacks
+            concurrency: (Int) maximum number of checks running at once
+            limits: (Limits) applied to every check process"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._scheduler = scheduler
+        self._concurrency = int(concurrency)
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._callbacks = {}
+        self._keys = {}
+        self._process = None
+        self._stopped = False
+
+    def start(self):
+        """Start the launcher process."""
+        with self._lock:
+            self._spawn()
+
+    def stop(self):
+        """Stop the launcher process, killing any running checks."""
+        with self._lock:
+            self._stopped = True
+            if self._process:
+                self._process.stdin.close()
+
+    def execute(self, command, service, timeout, callback, output=False,
+                key=None):
+        """Send a check to the launcher. Returns immediately.
+
+        Args:
+            command: (String) command to execute
+            service: (String) service name, used for metrics
+            timeout: (Int) seconds before the check is killed
+            callback: (Callable) called with the exit code of the command,
+                      and with its output too if output is set
+            output: (Boolean) keep the first MAX_OUTPUT bytes of stdout
+            key: (Hashable) identifies the check to cancel()"""
+        request = {'id': next(self._counter), 'cmd': command,
+                   'timeout': timeout, 'output': output}
+        if output:
+            callback = functools.partial(self._with_output, callback)
+        with self._lock:
+            self._callbacks[request['id']] = (callback, service, command,
+                                              time.time(), key)
+            if key is not None:
+                self._keys[key] = request['id']
+            self._send(request)
+
+    def cancel(self, key):
+        """Have the launcher kill the last check started with key, if it is
+        still running. Its callback is still called."""
+        with self._lock:
+            id = self._keys.pop(key, None)
+            if id in self._callbacks:
+                self._send({'cancel': id})
+
+    def _send(self, request):
+        """Must be called with self._lock held."""
+        try:
+            self._process.stdin.write(json.dumps(request) + '\n')
+            self._process.stdin.flush()
+        except (IOError, ValueError), e:
+            # The reader thread notices the launcher is gone, fails all
+            # of the outstanding checks and starts a new one.
+            self.log.warning('Could not send request to launcher: %s' % e)
+
+    def _with_output(self, callback, ret, output=''):
+        callback(ret, output)
+
+    def pid(self):
+        """Returns the pid of the launcher process, if there is one."""
+        with self._lock:
+            return self._process and self._process.pid
+
+    def in_flight(self):
+        """Returns the checks sent to the launcher, for diagnostics.
+
+        Returns:
+            A list of (service, command, pid, seconds running) tuples. The
+            pid is that of the launcher, which runs the actual commands."""
+        now = time.time()
+        with self._lock:
+            pid = self._process and self._process.pid
+            return [(service, command, pid, now - sent)
+                    for _, service, command, sent, _ in
+                    self._callbacks.values()]
+
+    def _spawn(self):
+        """Starts a launcher process and a thread reading its answers.
+
+        Must be called with self._lock held."""
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [package, env.get('PYTHONPATH')]))
+
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'zk_watcher.launcher',
+             '--concurrency', str(self._concurrency)] +
+            (self._limits.args() if self._limits else []),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+            env=env)
+        self.log.info('Started check launcher (pid %s)' % self._process.pid)
+
+        reader = threading.Thread(target=self._read, args=(self._process,),
+                                  name='LauncherEngine')
+        reader.setDaemon(True)
+        reader.start()
+
+    def _read(self, process):
+        for line in iter(process.stdout.readline, ''):
+            try:
+                response = json.loads(line)
+            except ValueError:
+                self.log.warning('Bad response from launcher: %r' % line)
+                continue
+
+            with self._lock:
+                callback, service, _, _, key = self._callbacks.pop(
+                    response['id'], (None, None, None, None, None))
+                if key is not None and self._keys.get(key) == response['id']:
+                    del self._keys[key]
+            if callback is None:
+                continue
+
+            if response.get('timeout'):
+                metrics.inc('zk_watcher_check_timeouts_total',
+                            service=service)
+            if 'output' in response:
+                callback = functools.partial(
+                    callback, response['ret'],
+                    response['output'].encode('latin-1'))
+            else:
+                callback = functools.partial(callback, response['ret'])
+            self._scheduler.submit(callback)
+
+        process.wait()
+        with self._lock:
+            failed = self._callbacks.values()
+            self._callbacks = {}
+            self._keys = {}
+            if not self._stopped:
+                self.log.error('Check launcher exited with %s, restarting it'
+                               % process.returncode)
+                self._spawn()
+
+        for callback, _, _, _, _ in failed:
+            self._scheduler.submit(functools.partial(callback, 1))
+
+
+class _Inline(object):
+    """Stands in for the Scheduler: runs callbacks in the calling thread."""
+
+    def submit(self, func):
+        func()
+
+
+def main():
+    parser = optparse.OptionParser(usage='usage: %prog <options>')
+    parser.add_option('--concurrency', dest='concurrency', type='int',
+                      default=32)
+    parser.add_option('--nice', dest='nice', type='int', default=None)
+    parser.add_option('--ionice', dest='ionice', default=None)
+    parser.add_option('--rlimit', dest='rlimit', default=None)
+    parser.add_option('--cgroup', dest='cgroup', default=None)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig()
+    lock = threading.Lock()
+
+    def reply(request, start, ret, output=None):
+        elapsed = time.time() - start
+        response = {'id': request['id'], 'ret': ret, 'time': elapsed,
+                    'timeout': elapsed >= request['timeout']}
+        if output is not None:
+            # JSON wants unicode; keep arbitrary bytes intact
+            response['output'] = output.decode('latin-1')
+        with lock:
+            try:
+                sys.stdout.write(json.dumps(response) + '\n')
+                sys.stdout.flush()
+            except IOError:
+                # The daemon has gone away, we'll exit shortly
+                pass
+
+    limits = Limits(nice=options.nice, ionice=options.ionice,
+                    rlimit=options.rlimit, cgroup=options.cgroup)
+    engine = LoopEngine(scheduler=_Inline(), concurrency=options.concurrency,
+                        limits=limits)
+    engine.start()
+
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        if 'cancel' in request:
+            engine.cancel(request['cancel'])
+            continue
+        engine.execute(request['cmd'], 'launcher', request['timeout'],
+                       functools.partial(reply, request, time.time()),
+                       output=request.get('output', False),
+                       key=request['id'])
+
+    # The daemon has gone away. Kill whatever is still running.
+    engine.stop()
+    engine.join()
+
+if __name__ == '__main__':
+    main()
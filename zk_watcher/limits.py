@@ -0,0 +1,197 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeping service checks from getting in the way of the services.
+
+When a host is already in trouble, its checks get slow, and a pile of them
+competes with the very services they are checking. Two things keep that in
+check:
+
+  * the Admission controller caps how many checks run at once across the
+    whole daemon; the others wait their turn in order,
+  * Limits are applied to every check process we spawn: a nice level, an IO
+    priority, resource limits and a cgroup to run in.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import resource
+import threading
+
+import metrics
+
+# ioprio_set(2) is not wrapped by libc, and its number differs per arch
+IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+}
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+
+class Admission(object):
+    """Caps the number of checks running at once, daemon wide."""
+
+    LOGGER = 'WatcherDaemon.Admission'
+
+    def __init__(self, scheduler, limit=32):
+        """Initialize the Admission object.
+
+        Args:
+            scheduler: (Scheduler) runs the checks that had to wait
+            limit: (Int) maximum number of checks running at once"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._scheduler = scheduler
+        self._limit = max(int(limit), 1)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = collections.OrderedDict()
+
+    def submit(self, func, key=None):
+        """Run func() (which starts a check) as soon as there is room.
+
+        If there is room right now func() is called right away, from the
+        calling thread. Whoever func() starts must call release() once the
+        check is done.
+
+        A func submitted with the key of one that is still waiting takes its
+        place in line, instead of waiting a second time."""
+        with self._lock:
+            if self._running >= self._limit:
+                self._waiting[key if key is not None else object()] = func
+                self._gauges()
+                return
+            self._running += 1
+            self._gauges()
+        func()
+
+    def release(self):
+        """Make room for the next check."""
+        with self._lock:
+            func = None
+            if self._waiting:
+                _, func = self._waiting.popitem(last=False)
+            else:
+                self._running -= 1
+            self._gauges()
+        if func:
+            self._scheduler.submit(func)
+
+    def _gauges(self):
+        metrics.set_gauge('zk_watcher_checks_running', self._running)
+        metrics.set_gauge('zk_watcher_checks_waiting', len(self._waiting))
+
+
+class Limits(object):
+    """Limits applied to every check process we spawn."""
+
+    LOGGER = 'WatcherDaemon.Limits'
+
+    def __init__(self, nice=None, ionice=None, rlimit=None, cgroup=None):
+        """Initialize the Limits object.
+
+        Args:
+            nice: (Int) niceness increment
+            ionice: (String) IO scheduling class (realtime, best-effort or
+                    idle), optionally followed by :<level>, eg. idle or
+                    best-effort:7
+            rlimit: (String) comma separated resource=limit pairs, eg.
+                    cpu=10,as=536870912,nofile=256 (see setrlimit(2))
+            cgroup: (String) directory of a cgroup to run the checks in
+
+        Raises:
+            ValueError if one of the settings is invalid."""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self.nice = int(nice) if nice is not None else None
+        self.ionice = ionice
+        self.rlimit = rlimit
+        self.cgroup = cgroup
+
+        if cgroup:
+            procs = os.path.join(cgroup, 'cgroup.procs')
+            if not os.access(procs, os.W_OK):
+                raise ValueError('Cannot move checks into cgroup %s: %s is '
+                                 'missing or not writable' % (cgroup, procs))
+
+        self._ioprio = None
+        if ionice:
+            name, _, level = ionice.partition(':')
+            if name not in IOPRIO_CLASSES:
+                raise ValueError('Unknown IO scheduling class: %s' % name)
+            self._ioprio = (IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT |
+                            int(level or 0))
+
+            # Look up everything now, in the parent; preexec_fn runs
+            # between fork and exec, where less is more.
+            number = IOPRIO_SET.get(platform.machine())
+            if number is None:
+                raise ValueError('ionice is not supported on %s' %
+                                 platform.machine())
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._syscall = libc.syscall
+            self._ioprio_set = number
+
+        self._rlimits = []
+        for pair in (rlimit or '').split(','):
+            if not pair.strip():
+                continue
+            name, _, value = pair.partition('=')
+            limit = getattr(resource, 'RLIMIT_%s' % name.strip().upper(),
+                            None)
+            if limit is None:
+                raise ValueError('Unknown resource limit: %s' % name)
+            value = int(value)
+            hard = resource.getrlimit(limit)[1]
+            if hard != resource.RLIM_INFINITY and value > hard:
+                raise ValueError('Resource limit %s=%s is above the hard '
+                                 'limit of %s' % (name.strip(), value, hard))
+            self._rlimits.append((limit, value))
+
+    def __nonzero__(self):
+        return bool(self.nice or self.ionice or self.rlimit or self.cgroup)
+
+    def args(self):
+        """Returns these limits as launcher command line arguments."""
+        args = []
+        for name in ('nice', 'ionice', 'rlimit', 'cgroup'):
+            value = getattr(self, name)
+            if value:
+                args.extend(['--%s' % name, str(value)])
+        return args
+
+    def apply(self):
+        """Applies the limits to the current process.
+
+        Used as (part of) the preexec_fn of check processes."""
+        if self.cgroup:
+            with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as f:
+                f.write(str(os.getpid()))
+        if self.nice:
+            os.nice(int(self.nice))
+        if self._ioprio is not None:
+            if self._syscall(self._ioprio_set, IOPRIO_WHO_PROCESS, 0,
+                             self._ioprio) < 0:
+                raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+        for limit, value in self._rlimits:
+            resource.setrlimit(limit, (value, value))
@@ -0,0 +1,259 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeping logging off the path of the checks.
+
+Logging handlers write from whichever thread logs. A SysLogHandler whose
+/dev/log is backed up blocks a check worker, or the Publisher in the middle
+of an update, until syslog catches up. So setup_logger() puts a QueueHandler
+on the root logger instead, which only appends the records to a bounded
+queue, and a single LogWriter thread hands them to the real handler. When the
+queue is full, because the sink is stalled, records are dropped and counted
+rather than waited for; the LogWriter reports how many once it gets going
+again.
+
+The LogWriter also folds repeated warnings. After a warning has been
+written, others of the same logger with the same message are only counted
+for `window` seconds. Once the window is over, the last of them is written
+along with the count:
+
+  [WatcherDaemon.ServiceWatcher.web] [_finish]: (WARNING) [/bin/false]
+  returned a failed exit code [1] (240 times in the last 3600s)
+
+Loggers shared by every service (eg. of a Publisher) tell the services apart
+in their messages, so only identical messages are folded. The loggers of a
+single service are marked with per_service(); their warnings are folded by
+message format alone, so that eg. a check that is slow by a different number
+of seconds each time still only logs once.
+"""
+
+import collections
+import logging
+import Queue
+import threading
+import time
+import traceback
+
+import metrics
+
+# Records waiting to be written, at most
+QUEUE_SIZE = 10000
+
+# Seconds a close() waits for the queued records to be written
+FLUSH_TIMEOUT = 5
+
+# Distinct warnings being folded at once, at most
+MAX_REPEATS = 10000
+
+# Tells the LogWriter to stop
+_STOP = object()
+
+
+class _PerService(logging.Filter):
+    """Marks the records of a logger that is about a single service."""
+
+    def filter(self, record):
+        record.per_service = True
+        return True
+
+_PER_SERVICE = _PerService()
+
+
+def per_service(logger):
+    """Has the warnings of logger folded by their format, rather than by
+    their message. Returns the logger."""
+    logger.addFilter(_PER_SERVICE)
+    return logger
+
+
+class QueueHandler(logging.Handler):
+    """Passes records on to a LogWriter, without ever blocking."""
+
+    def __init__(self, writer):
+        """Initialize the QueueHandler object.
+
+        Args:
+            writer: (LogWriter) writes the records out"""
+        logging.Handler.__init__(self)
+        self._writer = writer
+
+    def emit(self, record):
+        try:
+            self._writer.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        """Formats the message of a record, right away.
+
+        The arguments of a record may well change before the LogWriter gets
+        to it, and tracebacks have to be formatted while they are current."""
+        record.template = record.msg
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(
+                traceback.format_exception(*record.exc_info)).rstrip('\n')
+            record.exc_info = None
+        return record
+
+    def flush(self):
+        self._writer.flush(FLUSH_TIMEOUT)
+
+    def close(self):
+        self._writer.stop(FLUSH_TIMEOUT)
+        logging.Handler.close(self)
+
+
+class _Repeat(object):
+    """A warning being folded."""
+
+    def __init__(self, started):
+        self.started = started
+        self.count = 1
+        self.last = None
+
+
+class LogWriter(object):
+    """Writes queued records out to a handler, from its own thread."""
+
+    def __init__(self, handler, window=3600, size=QUEUE_SIZE):
+        """Initialize the LogWriter object.
+
+        Args:
+            handler: (logging.Handler) the real handler, eg. a SysLogHandler
+            window: (Float) seconds to fold repeated warnings for, 0 to write
+                    every one of them
+            size: (Int) number of records to hold at most"""
+        self._handler = handler
+        self._window = float(window)
+        self._queue = Queue.Queue(size)
+        self._lock = threading.Lock()
+        self._dropped = 0
+        self._reported = 0
+        self._repeats = collections.OrderedDict()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='LogWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout):
+        """Writes what is queued, for up to timeout seconds, and stops."""
+        if not self._thread:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except Queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+    def flush(self, timeout):
+        """Waits up to timeout seconds for the queued records to be
+        written."""
+        if not self._thread:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except Queue.Full:
+            return
+        done.wait(timeout)
+
+    def put(self, record):
+        """Queues a record, or drops it if the queue is full."""
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            with self._lock:
+                self._dropped += 1
+            metrics.inc('zk_watcher_log_records_dropped_total')
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._repeats:
+                first = next(self._repeats.itervalues())
+                timeout = max(first.started + self._window - time.time(),
+                              0.01)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = None
+
+            now = time.time()
+            if item is _STOP:
+                self._summarize(now, stopping=True)
+                return
+            self._summarize(now)
+            if isinstance(item, threading._Event):
+                item.set()
+                continue
+
+            self._report_dropped()
+            if item is not None and not self._fold(item):
+                self._write(item)
+
+    def _fold(self, record):
+        """Returns True if the record repeats a recent warning."""
+        if not self._window or record.levelno != logging.WARNING:
+            return False
+
+        if getattr(record, 'per_service', False):
+            key = (record.name, getattr(record, 'template', record.msg))
+        else:
+            key = (record.name, record.msg)
+        repeat = self._repeats.get(key)
+        if repeat:
+            repeat.count += 1
+            repeat.last = record
+            metrics.inc('zk_watcher_log_records_folded_total')
+            return True
+        if len(self._repeats) < MAX_REPEATS:
+            self._repeats[key] = _Repeat(record.created)
+        return False
+
+    def _summarize(self, now, stopping=False):
+        """Writes out the repeats whose window is over, or all of them when
+        stopping."""
+        while self._repeats:
+            key, repeat = next(self._repeats.iteritems())
+            if not stopping and repeat.started + self._window > now:
+                return
+            del self._repeats[key]
+            if repeat.last is None:
+                continue
+            record = repeat.last
+            record.msg = '%s (%d times in the last %ds)' % (
+                record.msg, repeat.count, round(now - repeat.started))
+            self._write(record)
+
+    def _report_dropped(self):
+        with self._lock:
+            dropped = self._dropped - self._reported
+            self._reported = self._dropped
+        if dropped:
+            record = logging.LogRecord(
+                'WatcherDaemon.LogWriter', logging.WARNING, __file__, 0,
+                'Dropped %d log records while the log was stalled',
+                (dropped,), None, '_report_dropped')
+            self._write(record)
+
+    def _write(self, record):
+        try:
+            self._handler.handle(record)
+        except Exception:
+            self._handler.handleError(record)
@@ -0,0 +1,287 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Internal metrics, served in the Prometheus text format.
+
+The daemon records its metrics into the module level METRICS object through
+the inc(), set_gauge() and observe() shortcuts. Recording is always on and
+cheap; the optional MetricsServer renders them on request:
+
+  $ zk_watcher --metrics=9120
+  $ curl http://localhost:9120/metrics
+"""
+
+import BaseHTTPServer
+import bisect
+import copy
+import logging
+import os
+import SocketServer
+import threading
+
+# Upper bounds (seconds) of our histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           90)
+
+# Every metric we export: name -> (type, help)
+DEFINITIONS = {
+    'zk_watcher_check_duration_seconds':
+        ('histogram', 'Time taken by service checks.'),
+    'zk_watcher_check_cache_hits_total':
+        ('counter', 'Service checks answered by another run of the same '
+                    'command.'),
+    'zk_watcher_check_failures_total':
+        ('counter', 'Service checks that did not pass.'),
+    'zk_watcher_check_overruns_total':
+        ('counter', 'Service checks that ran longer than their interval.'),
+    'zk_watcher_check_runs_skipped_total':
+        ('counter', 'Service checks not run because the previous one was '
+                    'still running.'),
+    'zk_watcher_checks_running':
+        ('gauge', 'Service checks running right now.'),
+    'zk_watcher_checks_waiting':
+        ('gauge', 'Service checks waiting for room to run.'),
+    'zk_watcher_process_exits_total':
+        ('counter', 'Watched service processes that exited.'),
+    'zk_watcher_watchdog_expired_total':
+        ('counter', 'Times the watchdog gave up on a stuck check.'),
+    'zk_watcher_check_timeouts_total':
+        ('counter', 'Service checks killed for taking too long.'),
+    'zk_watcher_check_interval_seconds':
+        ('gauge', 'Current check interval, with min_refresh/max_refresh.'),
+    'zk_watcher_schedule_lag_seconds':
+        ('histogram', 'How late checks started compared to their schedule.'),
+    'zk_watcher_publish_seconds':
+        ('histogram', 'Time from queueing a node update to its commit.'),
+    'zk_watcher_ensemble_publish_seconds':
+        ('histogram', 'Time from queueing a node update to its commit, per '
+                      'ZooKeeper ensemble.'),
+    'zk_watcher_ensemble_publish_failures_total':
+        ('counter', 'Node updates an ensemble could not commit.'),
+    'zk_watcher_ensemble_restarts_total':
+        ('counter', 'Times a stuck connection to an ensemble was replaced.'),
+    'zk_watcher_connected':
+        ('gauge', 'Whether we are connected to the ZooKeeper ensemble.'),
+    'zk_watcher_publish_failures_total':
+        ('counter', 'Node updates that could not be written to ZooKeeper.'),
+    'zk_watcher_writes_total':
+        ('counter', 'Node updates sent to ZooKeeper.'),
+    'zk_watcher_writes_suppressed_total':
+        ('counter', 'Node updates skipped because nothing changed.'),
+    'zk_watcher_registered':
+        ('gauge', 'Whether the service is currently registered.'),
+    'zk_watcher_commit_seconds':
+        ('histogram', 'Time taken to commit a batch of updates.'),
+    'zk_watcher_publish_pending':
+        ('gauge', 'Node updates waiting to be committed.'),
+    'zk_watcher_startup_seconds':
+        ('gauge', 'Seconds from process start until every service had been '
+                  'checked, and published.'),
+    'zk_watcher_log_records_dropped_total':
+        ('counter', 'Log records dropped because the log could not keep '
+                    'up.'),
+    'zk_watcher_log_records_folded_total':
+        ('counter', 'Repeated warnings counted instead of written.'),
+    'zk_watcher_threads':
+        ('gauge', 'Threads running in the daemon.'),
+}
+
+
+class Histogram(object):
+    """Observation counts per bucket of BUCKETS (plus one for +Inf)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """A thread-safe collection of counters, gauges and histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._series.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def remove(self, **labels):
+        """Drop every series matching labels, eg. of a removed service."""
+        match = set(labels.items())
+        with self._lock:
+            for series in self._series.itervalues():
+                for key in series.keys():
+                    if match.issubset(key):
+                        del series[key]
+
+    def get(self, name):
+        """Returns a copy of every series of a metric.
+
+        Returns:
+            A dict of label tuples, eg. (('service', 'memcache'),), to the
+            value of that series. Histograms have counts (per bucket), sum
+            and count attributes."""
+        with self._lock:
+            return copy.deepcopy(self._series.get(name, {}))
+
+    def add_collector(self, func):
+        """Register func() to be called right before rendering.
+
+        Collectors update the gauges that are cheaper to compute on demand
+        (like the thread count) than to keep up to date."""
+        self._collectors.append(func)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        for func in self._collectors:
+            func()
+
+        lines = []
+        with self._lock:
+            for name in sorted(self._series):
+                if not self._series[name]:
+                    continue
+                metric_type, help = DEFINITIONS.get(name, ('untyped', ''))
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for key, value in sorted(self._series[name].iteritems()):
+                    if isinstance(value, Histogram):
+                        lines.extend(self._render_histogram(name, key, value))
+                    else:
+                        lines.append('%s%s %s' % (name, self._labels(key),
+                                                  value))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _render_histogram(self, name, key, hist):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+            cumulative += count
+            labels = self._labels(key + (('le', str(bound)),))
+            yield '%s_bucket%s %s' % (name, labels, cumulative)
+        yield '%s_sum%s %s' % (name, self._labels(key), hist.sum)
+        yield '%s_count%s %s' % (name, self._labels(key), hist.count)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def _labels(self, key):
+        if not key:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in key)
+
+
+# The metrics of this daemon, and shortcuts for recording into them
+METRICS = Metrics()
+inc = METRICS.inc
+set_gauge = METRICS.set_gauge
+observe = METRICS.observe
+remove = METRICS.remove
+add_collector = METRICS.add_collector
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is a path (or empty) on unix sockets
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logging.getLogger(MetricsServer.LOGGER).debug(format % args)
+
+
+class _TCPServer(BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class _UnixServer(SocketServer.UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+class MetricsServer(object):
+    """Serves METRICS over HTTP on a local port or a unix socket."""
+
+    LOGGER = 'WatcherDaemon.MetricsServer'
+
+    def __init__(self, address, metrics=METRICS):
+        """Initialize the MetricsServer object.
+
+        Args:
+            address: (String) a port (bound to localhost), host:port, or the
+                     path of a unix socket
+            metrics: (Metrics) what to serve"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        if address.startswith('/'):
+            self._server = _UnixServer(address, _Handler)
+        else:
+            host, _, port = address.rpartition(':')
+            self._server = _TCPServer((host or 'localhost', int(port)),
+                                      _Handler)
+        self._server.metrics = metrics
+        self._address = address
+
+    def start(self):
+        self.log.info('Serving metrics on %s' % self._address)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  kwargs={'poll_interval': 5},
+                                  name='MetricsServer')
+        thread.setDaemon(True)
+        thread.start()
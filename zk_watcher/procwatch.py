@@ -0,0 +1,299 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""De-registering services the moment their process exits.
+
+A periodic check only notices a crashed service on its next run, up to
+`refresh` seconds later. A section can name the process behind the service
+instead, by pidfile or by a regular expression matching its command line:
+
+  pidfile: /var/run/memcached.pid
+  process: ^/usr/bin/memcached .*-p 11211
+
+The ProcessMonitor then holds a pidfd (see pidfd_open(2), Linux 5.3+) of that
+process, and a single thread waits on all of them at once. When the process
+exits its pidfd becomes readable, and the watcher of the service takes its
+node down right away.
+
+Once the process is gone there is nothing to wait on until a new one comes
+along. Rather than poll for that, the watcher re-arms the monitor whenever
+one of its regular checks passes. On kernels without pidfds the monitor
+falls back to looking for the processes in /proc every FALLBACK_INTERVAL
+seconds.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import threading
+
+# pidfd_open(2) has the same number on every architecture
+PIDFD_OPEN = 434
+
+# Seconds between looks at the processes without pidfds
+FALLBACK_INTERVAL = 0.5
+
+
+def find_process(pidfile=None, pattern=None):
+    """Returns the pid of a running process, or None.
+
+    Args:
+        pidfile: (String) file holding the pid of the process
+        pattern: (String) regular expression to search the command lines of
+                 all processes for. The oldest matching process wins."""
+    if pidfile:
+        try:
+            with open(pidfile) as f:
+                pid = int(f.read().split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+        if _start_time(pid) is None:
+            return None
+        return pid
+
+    regex = re.compile(pattern)
+    found = None
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % name) as f:
+                cmdline = f.read().replace('\0', ' ').strip()
+        except (IOError, OSError):
+            continue
+        if not cmdline or not regex.search(cmdline):
+            continue
+        started = _start_time(int(name))
+        if started is not None and (found is None or started < found[0]):
+            found = (started, int(name))
+    return found and found[1]
+
+
+def _start_time(pid):
+    """Returns the start time of a process (in clock ticks since boot).
+
+    Together with the pid it tells processes apart, since pids get reused.
+    None if there is no such process, or if it has exited already (and is
+    waiting to be reaped)."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # The command name (field 2) may contain spaces; skip past it
+    fields = stat.rsplit(')', 1)[1].split()
+    if fields[0] in ('Z', 'X'):
+        return None
+    return int(fields[19])
+
+
+class _Watch(object):
+    """A process we are watching for a watcher."""
+
+    def __init__(self, pidfile, pattern, callback):
+        self.pidfile = pidfile
+        self.pattern = pattern
+        self.callback = callback
+        self.pid = None
+        self.started = None
+        self.fd = None
+
+
+class ProcessMonitor(object):
+    """Tells watchers when their service's process exits."""
+
+    LOGGER = 'WatcherDaemon.ProcessMonitor'
+
+    def __init__(self):
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._fds = {}
+        self._poll = select.poll()
+        self._stopped = False
+        self._thread = None
+
+        # Registering new pidfds wakes our thread through this pipe
+        self._wake_r, self._wake_w = os.pipe()
+        self._poll.register(self._wake_r, select.POLLIN)
+
+        self._syscall = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._syscall = libc.syscall
+            fd = self._pidfd_open(os.getpid())
+            os.close(fd)
+        except (AttributeError, OSError), e:
+            self.log.info('pidfds are not available (%s), looking for exited '
+                          'processes every %ss instead' %
+                          (e, FALLBACK_INTERVAL))
+            self._syscall = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='ProcessMonitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        self._wake()
+
+    def watch(self, key, pidfile=None, pattern=None, callback=None):
+        """Start (or keep) watching the process of a watcher.
+
+        Args:
+            key: (Hashable) the watcher
+            pidfile: (String) file holding the pid of its process
+            pattern: (String) or a regular expression matching the command
+                     line of its process
+            callback: (Callable) called with the pid, from our thread, when
+                      the process exits"""
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch and (watch.pidfile, watch.pattern) == (pidfile, pattern):
+                watch.callback = callback
+                return
+            self._unwatch(key)
+            self._watches[key] = _Watch(pidfile, pattern, callback)
+        self.arm(key)
+
+    def unwatch(self, key):
+        """Stop watching the process of a watcher."""
+        with self._lock:
+            self._unwatch(key)
+
+    def arm(self, key):
+        """Find the process of a watcher, unless we are watching it already.
+
+        Returns:
+            The pid of the process, or None if it is not running."""
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch is None:
+                return None
+            if watch.pid is not None:
+                return watch.pid
+            pidfile, pattern = watch.pidfile, watch.pattern
+
+        # Looking through /proc can take a moment; don't hold the lock
+        pid = find_process(pidfile, pattern)
+        if pid is None:
+            return None
+        started = _start_time(pid)
+        fd = None
+        if self._syscall:
+            try:
+                fd = self._pidfd_open(pid)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    self.log.warning('Cannot watch process %s: %s' % (pid, e))
+                return None
+
+        with self._lock:
+            if self._watches.get(key) is not watch or watch.pid is not None:
+                if fd is not None:
+                    os.close(fd)
+                return watch.pid
+            watch.pid = pid
+            watch.started = started
+            if fd is not None:
+                watch.fd = fd
+                self._fds[fd] = key
+                self._poll.register(fd, select.POLLIN)
+        self.log.debug('Watching process %s' % pid)
+        self._wake()
+        return pid
+
+    def pid(self, key):
+        """Returns the pid we are watching for a watcher, or None."""
+        watch = self._watches.get(key)
+        return watch and watch.pid
+
+    def _pidfd_open(self, pid):
+        fd = self._syscall(PIDFD_OPEN, pid, 0)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return fd
+
+    def _unwatch(self, key):
+        """Must be called with self._lock held."""
+        watch = self._watches.pop(key, None)
+        if watch:
+            self._disarm(watch)
+
+    def _disarm(self, watch):
+        """Must be called with self._lock held."""
+        if watch.fd is not None:
+            self._poll.unregister(watch.fd)
+            self._fds.pop(watch.fd, None)
+            os.close(watch.fd)
+            watch.fd = None
+        watch.pid = None
+        watch.started = None
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                polling = not self._syscall and any(
+                    w.pid is not None for w in self._watches.itervalues())
+            timeout = FALLBACK_INTERVAL * 1000 if polling else None
+
+            try:
+                events = self._poll.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            exited = []
+            with self._lock:
+                for fd, _ in events:
+                    if fd == self._wake_r:
+                        os.read(self._wake_r, 4096)
+                        continue
+                    key = self._fds.get(fd)
+                    if key is not None:
+                        exited.append((key, self._watches[key]))
+                if polling:
+                    for key, watch in self._watches.iteritems():
+                        if watch.pid is not None and \
+                                _start_time(watch.pid) != watch.started:
+                            exited.append((key, watch))
+
+                for i, (key, watch) in enumerate(exited):
+                    exited[i] = (key, watch.pid, watch.callback)
+                    self._disarm(watch)
+
+            for key, pid, callback in exited:
+                self.log.debug('Process %s exited' % pid)
+                try:
+                    callback(pid)
+                except Exception, e:
+                    self.log.exception('Exit callback failed: %s' % e)
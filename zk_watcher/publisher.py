@@ -0,0 +1,515 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batching publisher that sits between the ServiceWatchers and ZooKeeper.
+
+ServiceWatchers hand their node updates to a Publisher instead of writing to
+the ServiceRegistry themselves. The Publisher collects updates for a short
+window (keeping only the latest update for each path) and commits them as
+ZooKeeper multi-op transactions, one round-trip per batch. If a batch fails,
+its updates are retried one node at a time.
+
+Transactions need the Kazoo client underneath the ServiceRegistry. In that
+mode the Publisher owns the ephemeral nodes it creates, and re-creates all of
+them in batches when the ZooKeeper session is lost. Registries without a
+Kazoo client get one set_node()/unset() call per update.
+
+While the Kazoo client is disconnected, updates are held back rather than
+failed: they pile up in the same latest-wins table (one entry per path), and
+are all committed in one pass as soon as Kazoo tells us it has reconnected.
+
+Each ZooKeeper ensemble we publish to gets a Publisher (and a connection) of
+its own, so that a slow or partitioned ensemble only holds up its own
+updates. A Fanout hands the updates of a watcher to several of them.
+
+A commit can also get stuck for good, in a ZooKeeper call that never
+returns. The Watchdog then has the Publisher restart() with a new connection.
+The stuck thread is left behind, and the old connection is closed, so the
+nodes of its session expire. Everything we want registered is committed again
+through the new connection.
+"""
+
+import json
+import logging
+import posixpath
+import threading
+import time
+
+import metrics
+
+# Default collection window (seconds) and maximum operations per transaction
+WINDOW = 0.05
+BATCH_SIZE = 100
+
+
+class _Op(object):
+    """A pending update of a single node."""
+
+    def __init__(self, path, data, state, unset=False, callback=None):
+        self.path = path
+        self.data = data
+        self.state = state
+        self.unset = unset
+        self.callback = callback
+        self.queued = time.time()
+
+
+class Publisher(object):
+    """Coalesces node updates and commits them to ZooKeeper in batches."""
+
+    LOGGER = 'WatcherDaemon.Publisher'
+
+    def __init__(self, registry, window=WINDOW, batch_size=BATCH_SIZE,
+                 name='default'):
+        """Initialize the Publisher object.
+
+        Args:
+            registry: (ServiceRegistry) registry to publish to
+            window: (Float) seconds to collect updates before committing
+            batch_size: (Int) maximum number of updates per transaction
+            name: (String) name of the ensemble behind the registry, for
+                  logs and metrics"""
+        self.name = name
+        self.log = logging.getLogger('%s.%s' % (self.LOGGER, name))
+
+        self._window = window
+        self._batch_size = int(batch_size)
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._urgent = False
+        self._stopped = False
+
+        # When the commit in progress started, if any (see stalled()), and
+        # the updates it is committing
+        self._busy_since = None
+        self._inflight = []
+        self._thread = None
+
+        # Kazoo mode bookkeeping: the nodes we have created in the current
+        # session, the parents we know exist, and every node we want to be
+        # registered (so we can put them back after losing the session).
+        self._created = set()
+        self._parents = set()
+        self._nodes = {}
+        self._lost = False
+        self._resync = False
+        self._connected = True
+        self._use(registry)
+
+    def _use(self, registry):
+        """Publish through registry from now on."""
+        self._registry = registry
+
+        # nd_service_registry does not expose its Kazoo client publicly.
+        self._zk = getattr(registry, '_zk', None)
+        if self._zk is not None:
+            self._zk.add_listener(self._state_listener)
+            with self._cond:
+                self._connected = self._zk.connected
+        else:
+            self._connected = True
+        metrics.set_gauge('zk_watcher_connected', int(self._connected),
+                          ensemble=self.name)
+
+    def start(self):
+        """Start the publishing thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='Publisher-%s' % self.name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def restart(self, registry):
+        """Start over with a new registry (and connection).
+
+        The thread stuck in a commit is abandoned: whatever it does once the
+        call returns is ignored. The updates it was committing, and every
+        node we have registered, are committed again through registry. The
+        old Kazoo client is stopped, so that its session, and the nodes
+        created in it, go away."""
+        with self._cond:
+            old = self._zk
+            if old is not None:
+                old.remove_listener(self._state_listener)
+            for op in self._inflight:
+                if op.path not in self._pending:
+                    self._pending[op.path] = op
+            for path, data in self._nodes.iteritems():
+                if path not in self._pending:
+                    self._pending[path] = _Op(path, data, True)
+            self._inflight = []
+            self._busy_since = None
+            self._created = set()
+            self._parents = set()
+            self._lost = False
+            self._resync = False
+            self._use(registry)
+            self.start()
+            self._cond.notify_all()
+
+        metrics.inc('zk_watcher_ensemble_restarts_total', ensemble=self.name)
+        if old is not None:
+            # Closing the connection may well hang too
+            closer = threading.Thread(target=self._close, args=(old,),
+                                      name='Publisher-%s-close' % self.name)
+            closer.setDaemon(True)
+            closer.start()
+
+    def _close(self, zk):
+        try:
+            zk.stop()
+            zk.close()
+        except Exception, e:
+            self.log.warning('Could not close the old connection: %s' % e)
+
+    def _abandoned(self):
+        """Whether the calling thread has been replaced by restart()."""
+        return threading.current_thread() is not self._thread
+
+    def idle(self):
+        """Whether we have no nodes, and nothing to commit."""
+        with self._cond:
+            return not (self._nodes or self._pending or self._inflight)
+
+    def stop(self):
+        """Commit whatever is pending, then stop the publishing thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def diagnostics(self):
+        """Returns a one line summary of our connection and queue."""
+        with self._cond:
+            return 'connected %s, %d updates pending, %d nodes' % (
+                self._connected, len(self._pending), len(self._nodes))
+
+    def stalled(self, now):
+        """Returns how many seconds the current commit has been going on.
+
+        0 if we are not committing anything right now."""
+        busy_since = self._busy_since
+        if busy_since is None:
+            return 0
+        return max(now - busy_since, 0)
+
+    def set_node(self, path, data, state, callback=None, urgent=False):
+        """Queue up a registration (state=True) or de-registration.
+
+        Args:
+            path: (String) full path of the node
+            data: (Dict) data to store in the node
+            state: (Boolean) whether the node should exist
+            callback: (Callable) called with True or False once the update
+                      has been committed (or has failed). Not called if the
+                      update is replaced by a newer one for the same path.
+            urgent: (Boolean) commit right away instead of waiting for the
+                    rest of the batch window"""
+        self._queue(_Op(path, data, state, callback=callback), urgent)
+
+    def unset(self, path, callback=None):
+        """Queue up the removal of a node we no longer manage."""
+        self._queue(_Op(path, None, False, unset=True, callback=callback))
+
+    def _queue(self, op, urgent=False):
+        with self._cond:
+            self._pending[op.path] = op
+            self._urgent = self._urgent or urgent
+            if not self._connected:
+                metrics.set_gauge('zk_watcher_publish_pending',
+                                  len(self._pending), ensemble=self.name)
+            self._cond.notify()
+
+    def _hold(self, op):
+        """Put back an op that failed because we lost the connection.
+
+        It is committed again once we have reconnected, unless a newer
+        update for the same path has been queued in the meantime."""
+        with self._cond:
+            if self._abandoned():
+                return
+            if op.path not in self._pending:
+                self._pending[op.path] = op
+            metrics.set_gauge('zk_watcher_publish_pending',
+                              len(self._pending), ensemble=self.name)
+
+    def _state_listener(self, state):
+        # Called from a Kazoo thread, so only flag the change here.
+        with self._cond:
+            if state == 'CONNECTED':
+                self._connected = True
+                if self._pending:
+                    self.log.info('Reconnected to ZooKeeper, committing %s '
+                                  'held updates' % len(self._pending))
+                if self._lost:
+                    self._lost = False
+                    self._resync = True
+                self._cond.notify()
+            else:
+                if self._connected:
+                    self.log.warning('Lost connection to ZooKeeper (%s), '
+                                     'holding updates' % state)
+                self._connected = False
+                if state == 'LOST':
+                    self._lost = True
+            metrics.set_gauge('zk_watcher_connected', int(self._connected),
+                              ensemble=self.name)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # While disconnected, updates just collect in _pending
+                while not ((self._pending and self._connected) or
+                           self._resync or self._stopped):
+                    self._cond.wait()
+                if self._abandoned():
+                    return
+                stopped = self._stopped
+                urgent = self._urgent
+
+            # Give the other watchers a moment to add their updates to
+            # this batch.
+            if not stopped and not urgent:
+                time.sleep(self._window)
+
+            with self._cond:
+                if self._resync:
+                    self._resync = False
+                    self._requeue()
+                ops = self._pending.values()
+                self._pending = {}
+                self._urgent = False
+                self._inflight = ops
+                self._busy_since = time.time()
+                metrics.set_gauge('zk_watcher_publish_pending', len(ops),
+                                  ensemble=self.name)
+
+            try:
+                for i in xrange(0, len(ops), self._batch_size):
+                    if self._abandoned():
+                        return
+                    self._commit(ops[i:i + self._batch_size])
+            finally:
+                with self._cond:
+                    if not self._abandoned():
+                        self._busy_since = None
+                        self._inflight = []
+
+            if stopped or self._abandoned():
+                return
+
+    def _requeue(self):
+        """Queue every registered node again after losing the session.
+
+        Must be called with self._cond held."""
+        self.log.warning('ZooKeeper session was lost, re-creating %s nodes' %
+                         len(self._nodes))
+        self._created = set()
+        for path, data in self._nodes.iteritems():
+            if path not in self._pending:
+                self._pending[path] = _Op(path, data, True)
+
+    def _commit(self, ops):
+        start = time.time()
+        try:
+            self._commit_batch(ops)
+        finally:
+            metrics.observe('zk_watcher_commit_seconds', time.time() - start,
+                            ensemble=self.name)
+
+    def _commit_batch(self, ops):
+        if self._zk is None:
+            for op in ops:
+                self._commit_one(op)
+            return
+
+        try:
+            self._transaction(ops)
+        except Exception, e:
+            if self._disconnected(e) and not self._stopped:
+                self.log.debug('Holding batch of %s updates until we '
+                               'reconnect: %s', len(ops), e)
+                for op in ops:
+                    self._hold(op)
+                return
+            self.log.warning('Batch of %s updates failed (%s), falling back '
+                             'to individual writes' % (len(ops), e))
+            for op in ops:
+                self._commit_one(op)
+            return
+
+        self.log.debug('Committed batch of %s updates', len(ops))
+        for op in ops:
+            self._done(op, True)
+
+    def _transaction(self, ops):
+        """Commits ops as a single ZooKeeper multi-op."""
+        txn = self._zk.transaction()
+        count = 0
+        for op in ops:
+            if op.state:
+                if op.path in self._created:
+                    txn.set_data(op.path, self._encode(op.data))
+                else:
+                    self._ensure_parent(op.path)
+                    txn.create(op.path, self._encode(op.data),
+                               ephemeral=True)
+                count += 1
+            elif op.path in self._created:
+                txn.delete(op.path)
+                count += 1
+
+        if count:
+            for result in txn.commit():
+                if isinstance(result, Exception):
+                    raise result
+
+    def _commit_one(self, op):
+        """Commits a single op, outside of any transaction."""
+        if self._abandoned():
+            return
+        try:
+            if self._zk is None:
+                if op.unset:
+                    self._registry.unset(op.path)
+                else:
+                    self._registry.set_node(op.path, op.data, op.state)
+            elif op.state:
+                self._write(op.path, self._encode(op.data))
+            else:
+                self._delete(op.path)
+        except Exception, e:
+            if self._disconnected(e) and not self._stopped:
+                self.log.debug('Holding update of %s until we reconnect: %s',
+                               op.path, e)
+                self._hold(op)
+                return
+            self.log.warning('Could not update path %s with state %s: %s',
+                             op.path, op.state, e)
+            self._done(op, False)
+            return
+        self._done(op, True)
+
+    def _disconnected(self, e):
+        """Returns whether e means we are not connected to ZooKeeper."""
+        if self._zk is None:
+            return False
+
+        from kazoo.exceptions import (ConnectionClosedError, ConnectionLoss,
+                                      SessionExpiredError)
+        return isinstance(e, (ConnectionClosedError, ConnectionLoss,
+                              SessionExpiredError))
+
+    def _write(self, path, value):
+        from kazoo.exceptions import NodeExistsError, NoNodeError
+
+        if path in self._created:
+            try:
+                self._zk.set(path, value)
+                return
+            except NoNodeError:
+                self._created.discard(path)
+
+        try:
+            self._zk.create(path, value, ephemeral=True, makepath=True)
+        except NodeExistsError:
+            # Most likely left over from an earlier session of ours, and it
+            # would go away when that session expires. Replace it.
+            self._zk.delete(path)
+            self._zk.create(path, value, ephemeral=True, makepath=True)
+
+    def _delete(self, path):
+        from kazoo.exceptions import NoNodeError
+
+        try:
+            self._zk.delete(path)
+        except NoNodeError:
+            pass
+
+    def _ensure_parent(self, path):
+        parent = posixpath.dirname(path)
+        if parent not in self._parents:
+            self._zk.ensure_path(parent)
+            self._parents.add(parent)
+
+    def _encode(self, data):
+        return json.dumps(data or {})
+
+    def _done(self, op, success):
+        if self._abandoned():
+            # restart() has handed op to our new thread
+            return
+        metrics.observe('zk_watcher_ensemble_publish_seconds',
+                        time.time() - op.queued, ensemble=self.name)
+        if not success:
+            metrics.inc('zk_watcher_ensemble_publish_failures_total',
+                        ensemble=self.name)
+        if success:
+            if op.state:
+                self._created.add(op.path)
+                self._nodes[op.path] = op.data
+            else:
+                self._created.discard(op.path)
+                self._nodes.pop(op.path, None)
+
+        if op.callback:
+            try:
+                op.callback(success)
+            except Exception, e:
+                self.log.exception('Publish callback failed: %s' % e)
+
+
+class Fanout(object):
+    """Hands node updates to the Publishers of several ensembles.
+
+    Takes the same calls as a Publisher. Each Publisher commits its copy of
+    an update on its own, so one slow ensemble does not hold up the others.
+    """
+
+    def __init__(self, publishers):
+        """Initialize the Fanout object.
+
+        Args:
+            publishers: (List) the Publishers to hand the updates to"""
+        self.publishers = publishers
+
+    def set_node(self, path, data, state, callback=None, urgent=False):
+        """See Publisher.set_node().
+
+        The callback is called once every Publisher has committed the
+        update, with True only if all of them succeeded."""
+        done = self._gather(callback)
+        for publisher in self.publishers:
+            publisher.set_node(path, data, state, callback=done,
+                               urgent=urgent)
+
+    def unset(self, path, callback=None):
+        """See Publisher.unset()."""
+        done = self._gather(callback)
+        for publisher in self.publishers:
+            publisher.unset(path, callback=done)
+
+    def _gather(self, callback):
+        if callback is None:
+            return None
+
+        results = []
+        lock = threading.Lock()
+
+        def done(success):
+            with lock:
+                results.append(success)
+                finished = len(results) == len(self.publishers)
+            if finished:
+                callback(all(results))
+        return done
@@ -0,0 +1,82 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service registries the WatcherDaemon can publish to.
+
+By default the daemon publishes to ZooKeeper through
+nd_service_registry.KazooServiceRegistry. Any class with the same
+constructor and the methods below can be passed to the WatcherDaemon as its
+registry_class instead:
+
+  Registry(server, lazy, username, password)
+  set_node(node, data, state)
+  unset(node)
+  set_username(username)
+  set_password(password)
+
+The MemoryRegistry below keeps everything in memory, and records every call
+made to it. It is used by the benchmarks, and is handy for trying out config
+files without a ZooKeeper ensemble.
+"""
+
+import copy
+import threading
+import time
+
+
+def get_default_registry():
+    """Returns the KazooServiceRegistry class.
+
+    nd_service_registry (and Kazoo with it) is only imported when we really
+    need it."""
+    from nd_service_registry import KazooServiceRegistry
+    return KazooServiceRegistry
+
+
+class MemoryRegistry(object):
+    """In-memory stand-in for KazooServiceRegistry."""
+
+    def __init__(self, server=None, lazy=False, username=None, password=None,
+                 **kwargs):
+        self.server = server
+        self.username = username
+        self.password = password
+
+        # Every call made to us: (time, method, node, data, state)
+        self.calls = []
+
+        # The nodes currently registered: node -> data
+        self.nodes = {}
+
+        self._lock = threading.Lock()
+
+    def set_node(self, node, data={}, state=True):
+        with self._lock:
+            self.calls.append((time.time(), 'set_node', node,
+                               copy.deepcopy(data), state))
+            if state:
+                self.nodes[node] = copy.deepcopy(data)
+            else:
+                self.nodes.pop(node, None)
+
+    def unset(self, node):
+        with self._lock:
+            self.calls.append((time.time(), 'unset', node, None, None))
+            self.nodes.pop(node, None)
+
+    def set_username(self, username):
+        self.username = username
+
+    def set_password(self, password):
+        self.password = password
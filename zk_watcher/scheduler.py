@@ -0,0 +1,175 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deadline scheduler shared by every ServiceWatcher.
+
+A single timer thread keeps a min-heap of (deadline, job) entries and sleeps
+until the earliest deadline is due. Due jobs are handed to a fixed-size pool
+of worker threads, so the number of threads (and idle wakeups) stays the same
+no matter how many services are configured.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import select
+import threading
+import time
+
+
+class Scheduler(object):
+    """Runs callables in a bounded worker pool at a requested time."""
+
+    LOGGER = 'WatcherDaemon.Scheduler'
+
+    def __init__(self, workers=8):
+        """Initialize the Scheduler object.
+
+        Args:
+            workers: (Int) number of worker threads executing due jobs"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._workers = int(workers)
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._stopped = False
+
+        # threading.Condition.wait(timeout) polls in 50ms steps under Python
+        # 2, so the timer thread sleeps in select() on a pipe instead. Writing
+        # a byte to the pipe wakes it up early when an earlier deadline is
+        # added.
+        self._wake_r, self._wake_w = os.pipe()
+
+    def start(self):
+        """Start the timer thread and the worker pool."""
+        self.log.debug('Starting scheduler with %s workers' % self._workers)
+        timer = threading.Thread(target=self._timer, name='Scheduler')
+        self._threads.append(timer)
+        for i in xrange(self._workers):
+            worker = threading.Thread(target=self._worker,
+                                      name='Scheduler-worker-%s' % i)
+            self._threads.append(worker)
+
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        """Stop the timer thread and let the workers drain their queue.
+
+        Jobs already handed to the workers (or submitted with submit()) still
+        run before the workers exit."""
+        with self._lock:
+            self._stopped = True
+            self._heap = []
+            self._entries = {}
+        self._wake()
+        for i in xrange(self._workers):
+            self._queue.put(None)
+
+    def schedule(self, key, delay, func):
+        """Run func() in the worker pool after delay seconds.
+
+        Any run already pending for key is replaced, so each key has at most
+        one pending run at a time.
+
+        Args:
+            key: (Hashable) identifies the job, eg. a ServiceWatcher
+            delay: (Float) seconds from now
+            func: (Callable) the job to run"""
+        deadline = time.time() + max(delay, 0)
+        with self._lock:
+            if self._stopped:
+                return
+            self._cancel(key)
+            entry = [deadline, next(self._counter), key, func]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            earliest = self._heap[0] is entry
+
+        # Only the timer thread cares about the new entry if it's now the
+        # first one due.
+        if earliest:
+            self._wake()
+
+    def cancel(self, key):
+        """Drop the pending run for key, if any."""
+        with self._lock:
+            self._cancel(key)
+
+    def submit(self, func):
+        """Hand func() to the worker pool right away."""
+        self._queue.put(func)
+
+    def _cancel(self, key):
+        # Entries are removed lazily; the timer thread skips dead ones.
+        entry = self._entries.pop(key, None)
+        if entry:
+            entry[-1] = None
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _timer(self):
+        """Sleep until the next deadline, then hand due jobs to the workers."""
+        while True:
+            due = []
+            with self._lock:
+                if self._stopped:
+                    return
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    if entry[-1] is None:
+                        continue
+                    del self._entries[entry[2]]
+                    due.append(entry[-1])
+
+                if self._heap:
+                    timeout = self._heap[0][0] - now
+                else:
+                    timeout = None
+
+            for func in due:
+                self._queue.put(func)
+
+            if due:
+                continue
+
+            try:
+                ready, _, _ = select.select([self._wake_r], [], [], timeout)
+            except select.error:
+                continue
+            if ready:
+                os.read(self._wake_r, 4096)
+
+    def _worker(self):
+        """Run jobs off of the queue until we get a None."""
+        while True:
+            func = self._queue.get()
+            if func is None:
+                return
+            try:
+                func()
+            except Exception, e:
+                self.log.exception('Scheduled job failed: %s' % e)
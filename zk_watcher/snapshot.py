@@ -0,0 +1,161 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-disk snapshot of what we have published.
+
+Our registrations are ephemeral nodes, so they are gone shortly after the
+daemon stops. Without help, a restarted daemon only registers a service again
+once its first check has passed, and every deploy of the daemon makes the
+host drop out of service discovery for a while.
+
+The Snapshot keeps the last state and data we published for every path in a
+small JSON file:
+
+  {"nodes": {"/services/web/web1.mydomain.com:80":
+             {"state": true, "data": {"foo": "bar"}, "time": 1350000000.0}}}
+
+It is written (atomically) whenever that changes. On startup the
+ServiceWatchers can republish their last known healthy node from it right
+away, and confirm it with a real check afterwards.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Wait this long (seconds) after a change before writing, so that a burst of
+# changes is written once
+WRITE_DELAY = 1
+
+
+class Snapshot(object):
+    """The last published state and data of every path, kept on disk."""
+
+    LOGGER = 'WatcherDaemon.Snapshot'
+
+    def __init__(self, path, scheduler):
+        """Initialize the Snapshot object.
+
+        Args:
+            path: (String) the snapshot file
+            scheduler: (Scheduler) runs our delayed writes"""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._path = path
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._restorable = {}
+        self._dirty = False
+        self._pending = False
+        self._closed = False
+
+    def load(self):
+        """Read the snapshot left behind by the previous run.
+
+        Its healthy nodes can then be claimed with restore()."""
+        try:
+            with open(self._path) as f:
+                nodes = json.load(f)['nodes']
+        except (IOError, OSError), e:
+            self.log.info('No snapshot to restore from (%s)' % e)
+            return
+        except (ValueError, KeyError, TypeError), e:
+            self.log.warning('Ignoring unreadable snapshot %s: %s' %
+                             (self._path, e))
+            return
+
+        with self._lock:
+            self._restorable = dict(
+                (path, node['data']) for path, node in nodes.iteritems()
+                if node.get('state'))
+        self.log.info('Loaded %d healthy nodes from %s' %
+                      (len(self._restorable), self._path))
+
+    def restore(self, path):
+        """Claim the snapshotted data of a path that was healthy.
+
+        Returns:
+            The data of the node, or None if it was not registered."""
+        with self._lock:
+            return self._restorable.pop(path, None)
+
+    def discard_restorable(self):
+        """Forget the nodes of the previous run that nobody claimed."""
+        with self._lock:
+            self._restorable = {}
+
+    def record(self, path, state, data):
+        """Remember what we published for a path."""
+        with self._lock:
+            old = self._nodes.get(path)
+            if old and old['state'] == state and old['data'] == data:
+                return
+            self._nodes[path] = {'state': state, 'data': data,
+                                 'time': time.time()}
+            self._changed()
+
+    def remove(self, path):
+        """Forget a path that is no longer watched."""
+        with self._lock:
+            if self._nodes.pop(path, None) is not None:
+                self._changed()
+
+    def close(self):
+        """Write out any pending changes, and ignore any later ones.
+
+        Called at shutdown, so that the de-registrations of the stopping
+        watchers do not end up in the snapshot."""
+        with self._lock:
+            self._closed = True
+            dirty = self._dirty
+        if dirty:
+            self._write()
+
+    def _changed(self):
+        """Must be called with self._lock held."""
+        self._dirty = True
+        if not self._pending and not self._closed:
+            self._pending = True
+            self._scheduler.schedule(self, WRITE_DELAY, self._write)
+
+    def _write(self):
+        with self._lock:
+            self._pending = False
+            if not self._dirty:
+                return
+            content = json.dumps({'nodes': self._nodes})
+            self._dirty = False
+
+        # Write to a temporary file next to the snapshot and rename it over
+        # the old one, so that a crash never leaves a half written file.
+        directory = os.path.dirname(os.path.abspath(self._path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.snapshot.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self._path)
+            except:
+                os.unlink(tmp)
+                raise
+        except (IOError, OSError), e:
+            self.log.error('Could not write snapshot %s: %s' % (self._path, e))
+            with self._lock:
+                self._changed()
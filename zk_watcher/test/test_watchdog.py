@@ -0,0 +1,105 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A hung check must not take the healthy sections down with it.
+
+Run with: python -m unittest discover zk_watcher/test
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from zk_watcher import zk_watcher as daemon
+from zk_watcher.registry import MemoryRegistry
+
+CONFIG = """[stuck]
+cmd: /bin/sleep 1000
+refresh: 1
+service_port: 80
+service_hostname: test.example.com
+zookeeper_path: /svc/stuck
+
+[ok]
+cmd: /bin/true
+refresh: 1
+service_port: 80
+service_hostname: test.example.com
+zookeeper_path: /svc/ok
+"""
+
+OK = '/svc/ok/test.example.com:80'
+
+# Long enough for the watchdog to give up on the stuck check a few times
+DURATION = 8
+
+
+class StuckCheckTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='zk_watcher_test.')
+        self.config = os.path.join(self.path, 'config.cfg')
+        with open(self.config, 'w') as f:
+            f.write(CONFIG)
+        self.registry = MemoryRegistry()
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher.join(10)
+        shutil.rmtree(self.path)
+
+    def run_daemon(self, **kwargs):
+        self.watcher = daemon.WatcherDaemon(
+            server='memory',
+            config_file=self.config,
+            config_dir=os.path.join(self.path, 'config.d'),
+            fast_start=True,
+            watchdog=2,
+            registry_class=lambda **k: self.registry,
+            **kwargs)
+
+        running = 0
+        start = time.time()
+        while time.time() - start < DURATION:
+            time.sleep(0.5)
+            running = max(running, len(self.watcher._checks.in_flight()))
+        return running
+
+    def assert_healthy(self, running):
+        # Expired runs are killed rather than piling up...
+        self.assertTrue(running <= 2, '%d checks running at once' % running)
+
+        # ...so the healthy section keeps being checked and stays up
+        self.assertTrue(OK in self.registry.nodes)
+        removed = [call for call in self.registry.calls
+                   if call[2] == OK and
+                   (call[1] == 'unset' or not call[4])]
+        self.assertEqual(removed, [])
+
+    def test_thread_engine(self):
+        self.assert_healthy(self.run_daemon(engine='thread', workers=4))
+
+    def test_loop_engine(self):
+        self.assert_healthy(self.run_daemon(engine='loop', max_checks=3))
+
+    def test_launcher_engine(self):
+        self.assert_healthy(self.run_daemon(engine='launcher', max_checks=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
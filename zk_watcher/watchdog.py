@@ -0,0 +1,131 @@
+# Copyright 2012 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Supervision of the ServiceWatchers and the Publisher.
+
+A registration is only as fresh as the last check behind it. If a check gets
+stuck (in the engine, or waiting for a worker) the last state we published
+stays in ZooKeeper, healthy or not, for as long as it takes.
+
+The Watchdog runs in a thread of its own, so that it keeps going when the
+Scheduler's workers are all stuck. Every second it asks each watcher whether
+its check is overdue by more than `multiple` check intervals. An overdue
+watcher takes its node down right away and runs its command anew (see
+ServiceWatcher.expire()). So a healthy registration is advertised for at
+most about `multiple` intervals after the last check that passed. Checks
+still waiting for admission are left alone: they are only held up by the
+ones running, and restarting them would just put them back in line.
+
+Node updates themselves can get stuck too, in a ZooKeeper call that never
+returns. There is no taking nodes down through a connection like that, so
+once a Publisher has been busy with a commit for PUBLISH_DEADLINE seconds,
+its ensemble is restarted: the Publisher drops the connection, which
+removes the (ephemeral) nodes of its session, and commits everything again
+through a new one. The other ensembles carry on undisturbed. Only if every
+ensemble we publish to is stuck does the whole daemon exit, so that the
+init system can start us over.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from diagnostics import thread_stacks
+
+# Seconds between rounds, seconds a single commit may take, and the exit
+# code we leave with when the commits of every ensemble take longer than
+# that
+INTERVAL = 1
+PUBLISH_DEADLINE = 60
+EXIT_CODE = 3
+
+
+class Watchdog(object):
+    """Restarts stuck watchers and Publishers."""
+
+    LOGGER = 'WatcherDaemon.Watchdog'
+
+    def __init__(self, watchers, publishers, multiple=5, restart=None):
+        """Initialize the Watchdog object.
+
+        Args:
+            watchers: (Callable) returns the watchers to supervise
+            publishers: (List) the Publishers to supervise, one per ensemble
+            multiple: (Float) check intervals a watcher may be late by
+            restart: (Callable) called with a stuck Publisher to give it a
+                     new connection. Without it, any stuck Publisher makes
+                     the daemon exit."""
+        self.log = logging.getLogger(self.LOGGER)
+
+        self._watchers = watchers
+        self._publishers = publishers
+        self._multiple = multiple
+        self._restart = restart
+        self._event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.log.debug('Expiring checks %s intervals late' % self._multiple)
+        self._thread = threading.Thread(target=self._run, name='Watchdog')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._event.set()
+        if self._thread:
+            self._thread.join(INTERVAL * 2)
+
+    def _run(self):
+        while not self._event.wait(INTERVAL):
+            now = time.time()
+            for watcher in self._watchers():
+                try:
+                    if watcher.overdue(now, self._multiple):
+                        watcher.expire()
+                except Exception, e:
+                    self.log.exception('Could not supervise %s: %s' %
+                                       (watcher, e))
+
+            self._supervise_publishers(now)
+
+    def _supervise_publishers(self, now):
+        stuck = [p for p in self._publishers
+                 if p.stalled(now) > PUBLISH_DEADLINE]
+        if not stuck:
+            return
+
+        # Ensembles none of our nodes are in have nothing to lose
+        used = [p for p in self._publishers if not p.idle()]
+        if self._restart and len(stuck) < len(used):
+            for publisher in stuck:
+                self.log.critical(
+                    'Updates of ZooKeeper ensemble %s have been stuck for '
+                    '%.1fs, reconnecting to it\n%s' % (
+                        publisher.name, publisher.stalled(now),
+                        '\n'.join(thread_stacks())))
+                try:
+                    self._restart(publisher)
+                except Exception, e:
+                    self.log.exception('Could not restart ensemble %s: %s' %
+                                       (publisher.name, e))
+            return
+
+        self.log.critical(
+            'Updates of ZooKeeper ensembles %s have been stuck for over %ss, '
+            'exiting so that our sessions and nodes expire\n%s' % (
+                ', '.join(p.name for p in stuck), PUBLISH_DEADLINE,
+                '\n'.join(thread_stacks())))
+        logging.shutdown()
+        os._exit(EXIT_CODE)
@@ -35,40 +35,94 @@ monitor the service. Eg:
   zookeeper_path: /services/prod-uswest1-mc
   zookeeper_data: { "foo": "bar", "bar": "foo" }
 
+Instead of a 'cmd', a section can use one of the native checks (tcp, http,
+unix or pidfile) which run inside the daemon without spawning anything:
+
+  [memcache]
+  check: tcp
+  check_timeout: 2
+  refresh: 30
+  service_port: 11211
+  zookeeper_path: /services/prod-uswest1-mc
+
 Copyright 2012 Nextdoor Inc.
 """
 
 __author__ = 'matt@nextdoor.com (Matt Wise)'
 
 from sys import stdout, stderr
+import collections
+import copy
+import functools
 import optparse
 import socket
 import subprocess
+import tempfile
 import threading
 import time
 import json
 import signal
-import ConfigParser
+import Queue
 import logging
 import logging.handlers
 import os
-
-# Get our ServiceRegistry class
-from nd_service_registry import KazooServiceRegistry as ServiceRegistry
-from nd_service_registry import exceptions
+import random
+import zlib
 
 # Our default variables
 from version import __version__ as VERSION
+import checks
+import logpipe
+import metrics
+from admin import AdminError, AdminServer
+from cache import CheckCache
+from config import ConfigLoader, ConfigWatcher
+from damping import StateFilter
+from diagnostics import Sampler, StartupTimer, StartupTracker, TimingStats
+from diagnostics import thread_stacks
+from dynamic import MAX_OUTPUT, DataFilter, parse_output
+from engine import LoopEngine
+from launcher import LauncherEngine
+from limits import Admission, Limits
+from metrics import MetricsServer
+from procwatch import ProcessMonitor
+from publisher import Fanout, Publisher
+from registry import get_default_registry
+from scheduler import Scheduler
+from snapshot import Snapshot
+from watchdog import Watchdog
 
 # Defaults
 LOG = '/var/log/zk_watcher.log'
 ZOOKEEPER_SESSION_TIMEOUT_USEC = 300000  # microseconds
 ZOOKEEPER_URL = 'localhost:2181'
+WORKERS = 8
+MAX_CHECKS = 32
+CHECK_TIMEOUT = 90
+CHECK_KILL_GRACE = 5  # seconds between SIGTERM and SIGKILL
+RECONCILE = 300
+BATCH_WINDOW = 50  # milliseconds
+WATCHDOG = 5  # check intervals
+LOG_REPEAT_WINDOW = 3600  # seconds
+
+# Seconds a drain on the admin socket waits for ZooKeeper to confirm it
+DRAIN_TIMEOUT = 10
+
+# Seconds after which we complain if not every service has been checked and
+# published since startup
+STARTUP_TIMEOUT = 300
+
+# Config values that mean "yes", like ConfigParser.getboolean() accepts
+BOOLEAN_TRUE = ('1', 'yes', 'true', 'on')
+
+# With min_refresh/max_refresh, how much the check interval grows after each
+# passing check
+REFRESH_GROWTH = 1.5
 
 # This global variable is used to trigger the service stopping/starting...
 RUN_STATE = True
 
-# First handle all of the options passed to us
+# All of the options we can be started with. They're parsed in main().
 usage = 'usage: %prog <options>'
 parser = optparse.OptionParser(usage=usage, version=VERSION,
                                add_help_option=True)
@@ -76,15 +130,99 @@ parser.set_defaults(verbose=True)
 parser.add_option('-c', '--config', dest='config',
                   default='/etc/zk/config.cfg',
                   help='override the default config file (/etc/zk/config.cfg)')
-parser.add_option('-s', '--server', dest='server', default=ZOOKEEPER_URL,
-                  help='server address (default: localhost:2181')
+parser.add_option('-d', '--config-dir', dest='config_dir',
+                  default='/etc/zk/conf.d',
+                  help='also read every *.cfg file in this directory '
+                       '(default: /etc/zk/conf.d)')
+parser.add_option('--watch-config', action='store_true', dest='watch_config',
+                  default=False,
+                  help='reload the config as soon as any of its files '
+                       'change, instead of only on SIGHUP')
+parser.add_option('-s', '--server', dest='server', action='append',
+                  default=None,
+                  help='ZooKeeper ensemble to publish to, as host:port,... '
+                       'or name=host:port,...; repeat to publish to several '
+                       'ensembles (default: %s)' % ZOOKEEPER_URL)
 parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
                   default=False,
                   help='verbose mode')
 parser.add_option('-l', '--syslog', action='store_true', dest='syslog',
                   default=False,
                   help='log to syslog')
-(options, args) = parser.parse_args()
+parser.add_option('--log-repeat-window', dest='log_repeat_window',
+                  type='float', default=LOG_REPEAT_WINDOW,
+                  help='seconds to fold repeated warnings of a service for; '
+                       'the repeats are written as a single summary at the '
+                       'end (default: %d, 0 to write every one)' %
+                       LOG_REPEAT_WINDOW)
+parser.add_option('-w', '--workers', dest='workers', type='int',
+                  default=WORKERS,
+                  help='number of threads running service checks '
+                       '(default: %d)' % WORKERS)
+parser.add_option('-e', '--engine', dest='engine', type='choice',
+                  choices=['thread', 'loop', 'launcher'], default='thread',
+                  help='how to run service checks: "thread" runs each check '
+                       'in a worker thread, "loop" runs all of them from a '
+                       'single event loop, "launcher" hands them to a small '
+                       'helper process so the daemon never forks '
+                       '(default: thread)')
+parser.add_option('-m', '--max-checks', dest='max_checks', type='int',
+                  default=MAX_CHECKS,
+                  help='maximum number of checks running at once; the '
+                       'others wait their turn (default: %d)' % MAX_CHECKS)
+parser.add_option('--check-nice', dest='check_nice', type='int',
+                  default=None,
+                  help='run check commands with this niceness increment')
+parser.add_option('--check-ionice', dest='check_ionice', default=None,
+                  help='run check commands in this IO scheduling class: '
+                       'idle, best-effort[:level] or realtime[:level]')
+parser.add_option('--check-rlimit', dest='check_rlimit', default=None,
+                  help='resource limits of check commands, eg. '
+                       'cpu=10,as=536870912,nofile=256')
+parser.add_option('--check-cgroup', dest='check_cgroup', default=None,
+                  help='run check commands in the cgroup at this path')
+parser.add_option('-r', '--reconcile', dest='reconcile', type='int',
+                  default=RECONCILE,
+                  help='re-assert unchanged registrations in ZooKeeper '
+                       'every N seconds (default: %d)' % RECONCILE)
+parser.add_option('--watchdog', dest='watchdog', type='float',
+                  default=WATCHDOG,
+                  help='take a node down and restart its checks once no '
+                       'check has finished for N check intervals, 0 to '
+                       'disable (default: %d)' % WATCHDOG)
+parser.add_option('--batch-window', dest='batch_window', type='int',
+                  default=BATCH_WINDOW,
+                  help='collect ZooKeeper updates for N milliseconds and '
+                       'commit them together (default: %d)' % BATCH_WINDOW)
+parser.add_option('-j', '--jitter', dest='jitter', type='float', default=0,
+                  help='delay each check by a random 0 to N seconds '
+                       '(default: 0)')
+parser.add_option('-f', '--fast-start', action='store_true',
+                  dest='fast_start', default=False,
+                  help='run every check immediately on startup instead of '
+                       'waiting for its slot in the refresh interval')
+parser.add_option('--state-file', dest='state_file', default=None,
+                  help='keep a snapshot of our registrations in this file '
+                       '(default: disabled)')
+parser.add_option('--restore-grace', dest='restore_grace', type='int',
+                  default=0,
+                  help='on startup, republish the nodes that were healthy '
+                       'in --state-file right away, and withdraw them '
+                       'unless a check confirms them within N seconds '
+                       '(default: 0, disabled)')
+parser.add_option('--dump-dir', dest='dump_dir', default=None,
+                  help='write the diagnostics dump SIGUSR1 asks for to a '
+                       'file in this directory (default: to the log)')
+parser.add_option('--profile', dest='profile', type='float', default=0,
+                  help='on SIGUSR1, also profile the daemon for N seconds '
+                       'and write the profile next to the dump '
+                       '(default: 0, disabled)')
+parser.add_option('--admin-socket', dest='admin_socket', default=None,
+                  help='serve admin commands (drain, undrain, check, status) '
+                       'on a unix socket at this path')
+parser.add_option('--metrics', dest='metrics', default=None,
+                  help='serve Prometheus metrics on a local port, host:port '
+                       'or unix socket path (default: disabled)')
 
 
 class WatcherDaemon(threading.Thread):
@@ -95,21 +233,110 @@ class WatcherDaemon(threading.Thread):
 
     LOGGER = 'WatcherDaemon'
 
-    def __init__(self, server, config_file, verbose=False):
+    def __init__(self, server, config_file, verbose=False, workers=WORKERS,
+                 engine='thread', max_checks=MAX_CHECKS,
+                 reconcile=RECONCILE, batch_window=BATCH_WINDOW, jitter=0,
+                 fast_start=False, metrics_address=None, registry_class=None,
+                 config_dir=None, watch_config=False, state_file=None,
+                 restore_grace=0, dump_dir=None, profile=0, limits=None,
+                 admin_socket=None, watchdog=WATCHDOG):
         """Initilization code for the main WatcherDaemon.
 
-        Set up our local logger reference, and pid file locations."""
+        Set up our local logger reference, and pid file locations.
+
+        registry_class is the ServiceRegistry implementation to publish to,
+        nd_service_registry.KazooServiceRegistry by default (see
+        registry.py).
+
+        server is a ZooKeeper connect string, or a list of them to publish
+        to several ensembles. Each can be named, as name=connect-string (see
+        _parse_servers()). Every ensemble gets a registry and a Publisher of
+        its own.
+
+        Sections are read from config_file, plus every *.cfg file in
+        config_dir. With watch_config, the config is reloaded whenever one
+        of those files changes.
+
+        With a state_file, our registrations are snapshotted to disk. If
+        restore_grace is set too, the nodes that were healthy when we last
+        stopped are republished on startup, and must be confirmed by a check
+        within restore_grace seconds.
+
+        SIGUSR1 dumps diagnostics to the log, or to a file in dump_dir. With
+        profile, the daemon is also profiled for that many seconds.
+
+        At most max_checks checks run at once, and every check process is
+        subject to limits (a limits.Limits object), if given.
+
+        With admin_socket, admin commands are served on a unix socket at
+        that path (see admin.py).
+
+        A watcher whose checks are late by more than watchdog intervals is
+        taken down and restarted (see watchdog.py), unless it is 0."""
         # Initiate our thread
         super(WatcherDaemon, self).__init__()
 
+        # How long it takes us to get every service registered, from the
+        # moment the process was started (see _startup_reached())
+        self._startup = StartupTimer()
+        self._startup.mark('import')
+        self._startup_tracker = StartupTracker(
+            ('first checks', 'first publish'), self._startup_reached)
+
         self.log = logging.getLogger(self.LOGGER)
         self.log.info('WatcherDaemon %s' % VERSION)
 
-        self._watchers = []
-        self._server_reg = None
-        self._config_file = config_file
-        self._server = server
+        # service name -> ServiceWatcher, and the config sections they were
+        # last set up from: service name -> (digest, options)
+        self._watchers = {}
+        self._sections = {}
+        self._registry_class = registry_class
+        self._batch_window = batch_window
+        self._loader = ConfigLoader(config_file, config_dir)
+        self._servers = self._parse_servers(server)
+
+        # ensemble name -> its ServiceRegistry, and its Publisher
+        self._registries = collections.OrderedDict()
+        self._publishers = collections.OrderedDict()
         self._verbose = verbose
+        self._reconcile = reconcile
+        self._jitter = jitter
+        self._fast_start = fast_start
+        self._watchdog = None
+        self._watchdog_multiple = watchdog
+        self._dump_dir = dump_dir
+        self._profile = profile
+
+        # All of the ServiceWatchers share one timer thread and a fixed pool
+        # of workers, rather than running a thread each.
+        self._scheduler = Scheduler(workers=workers)
+
+        self._snapshot = None
+        self._restore_grace = restore_grace
+        if state_file:
+            self._snapshot = Snapshot(state_file, self._scheduler)
+            if restore_grace:
+                self._snapshot.load()
+
+        # Pick how the check commands themselves get executed
+        if engine == 'loop':
+            self._engine = LoopEngine(scheduler=self._scheduler,
+                                      concurrency=max_checks, limits=limits)
+        elif engine == 'launcher':
+            self._engine = LauncherEngine(scheduler=self._scheduler,
+                                          concurrency=max_checks,
+                                          limits=limits)
+        else:
+            self._engine = ThreadEngine(limits=limits)
+
+        # Caps the checks running at once, whatever runs them
+        self._admission = Admission(self._scheduler, max_checks)
+
+        # Sections running the same command share its runs and results
+        self._checks = CheckCache(self._engine)
+
+        # Watches the processes named by the pidfile and process settings
+        self._monitor = ProcessMonitor()
 
         # Get a logger for nd_service_registry and set it to be quiet
         nd_log = logging.getLogger('nd_service_registry')
@@ -117,20 +344,53 @@ class WatcherDaemon(threading.Thread):
         # Set up our threading environment
         self._event = threading.Event()
 
+        # Reloads are requested from signal handlers and the ConfigWatcher,
+        # but done by our own thread (see run())
+        self._commands = Queue.Queue()
+        self._config_watcher = None
+        if watch_config:
+            try:
+                self._config_watcher = ConfigWatcher(
+                    self._loader, functools.partial(self._commands.put,
+                                                    'reload'))
+            except OSError, e:
+                self.log.warning('Cannot watch the config files (%s), '
+                                 'reloading on SIGHUP only' % e)
+
+        # Bind our sockets right away, so that a bad address is reported at
+        # startup rather than taking our thread down in run()
+        self._metrics_server = None
+        if metrics_address:
+            try:
+                self._metrics_server = MetricsServer(metrics_address)
+            except (IOError, OSError), e:
+                self.log.warning('Cannot serve metrics on %s (%s), running '
+                                 'without them' % (metrics_address, e))
+        self._admin_server = None
+        if admin_socket:
+            try:
+                self._admin_server = AdminServer(admin_socket, self._admin)
+            except (IOError, OSError), e:
+                self.log.warning('Cannot serve admin commands on %s (%s), '
+                                 'running without them' % (admin_socket, e))
+
         # These threads can die with prejudice. Make sure that any time the
         # python interpreter exits, we exit immediately
         self.setDaemon(True)
 
         # Watch for any signals
         signal.signal(signal.SIGHUP, self._signal_handler)
+        signal.signal(signal.SIGUSR1, self._signal_handler)
 
         # Bring in our configuration options
         # 1. 读取配置文件
         self._parse_config()
+        self._startup.mark('config')
 
         # Create our ServiceRegistry object
         # 2. 创建连接?
         self._connect()
+        self._startup.mark('connect')
 
         # Start up
         self.start()
@@ -140,47 +400,135 @@ class WatcherDaemon(threading.Thread):
         self.log.warning('Received signal: %s' % signum)
 
         # 重新加载config
-        if signum == 1:
+        # The reload itself is left to our own thread, so that signal
+        # handling never blocks on config parsing or ZooKeeper.
+        if signum == signal.SIGHUP:
             self.log.warning('Received SIGHUP. Reloading config.')
-            self._parse_config()
-            self._connect()
-            self._setup_watchers()
+            self._commands.put('reload')
+        elif signum == signal.SIGUSR1:
+            self._commands.put('dump')
+
+    def _reload(self):
+        """Re-read the config, and update the watchers that changed."""
+        start = time.time()
+        self._parse_config()
+        self._connect()
+        changed = self._setup_watchers()
+        self.log.info('Reloaded config in %.3fs: %d of %d sections changed'
+                      % (time.time() - start, changed, len(self._sections)))
 
     def _parse_config(self):
-        """Read in the supplied config file and update our local settings."""
+        """Read in the supplied config files and update our local settings."""
         self.log.debug('Loading config...')
 
         # 1. 如何读取config文件呢?
-        self._config = ConfigParser.ConfigParser()
-        self._config.read(self._config_file)
+        # Only files that changed since the last load are parsed again.
+        # self._config is a dict of service -> (digest, options)
+        self._config = self._loader.load()
 
         # 2. 读取auth数据
-        # Check if auth data was supplied. If it is, read it in and then remove
-        # it from our configuration object so its not used anywhere else.
-        try:
-            self.user = self._config.get('auth', 'user')
-            self.password = self._config.get('auth', 'password')
-            self._config.remove_section('auth')
-        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
-            self.user = None
-            self.password = None
+        # The loader strips the auth section from the config, so its not
+        # used anywhere else.
+        self.user = self._loader.user
+        self.password = self._loader.password
 
     def _connect(self):
-        """Connects to the ServiceRegistry.
+        """Connects to the ServiceRegistry of every ensemble.
 
         If already connected, updates the current connection settings."""
 
-        self.log.debug('Checking for ServiceRegistry object...')
-        if not self._server_reg:
-            self.log.debug('Creating new ServiceRegistry object...')
+        self.log.debug('Checking for ServiceRegistry objects...')
+        for name, server in self._servers.iteritems():
+            registry = self._registries.get(name)
+            if registry:
+                self.log.debug('Updating existing object for %s...' % name)
+                registry.set_username(self.user)
+                registry.set_password(self.password)
+                continue
+
+            self.log.debug('Creating new ServiceRegistry object for %s...' %
+                           name)
             # 通过用户名，密码连接到注册服务器
-            self._server_reg = ServiceRegistry(server=self._server, lazy=True, username=self.user, password=self.password)
-        else:
-            self.log.debug('Updating existing object...')
-            self._server_reg.set_username(self.user)
-            self._server_reg.set_password(self.password)
+            if self._registry_class is None:
+                self._registry_class = get_default_registry()
+            registry = self._registry_class(server=server, lazy=True, username=self.user, password=self.password)
+            self._registries[name] = registry
+
+            # All node updates go through the ensemble's Publisher, which
+            # batches them
+            self._publishers[name] = Publisher(
+                registry=registry, window=self._batch_window / 1000.0,
+                name=name)
+
+    def _reconnect(self, publisher):
+        """Gives a Publisher that is stuck a new connection to its
+        ensemble. Called by the Watchdog."""
+        name = publisher.name
+        registry = self._registry_class(server=self._servers[name],
+                                        lazy=True, username=self.user,
+                                        password=self.password)
+        self._registries[name] = registry
+        publisher.restart(registry)
+
+    def _parse_servers(self, servers):
+        """Convert the server setting into a dict of ensembles.
+
+        Each ensemble is given as a connect string, optionally named:
+
+            -s zk1:2181,zk2:2181
+            -s regional=zk1:2181,zk2:2181 -s global=gzk1:2181
+
+        An ensemble without a name is called 'default'.
+
+        Returns:
+            An OrderedDict of ensemble name -> connect string.
+
+        Raises:
+            ValueError if two ensembles have the same name."""
+        if isinstance(servers, basestring):
+            servers = [servers]
+
+        result = collections.OrderedDict()
+        for server in servers:
+            name, sep, hosts = server.partition('=')
+            if not sep:
+                name, hosts = 'default', server
+            name = name.strip()
+            if name in result:
+                raise ValueError('ZooKeeper ensemble %s is given twice' % name)
+            result[name] = hosts.strip()
+        return result
+
+    def _get_publisher(self, options):
+        """Returns the publisher of the ensembles a section publishes to.
+
+        That is every ensemble, unless the section lists some of them in its
+        zookeeper_ensembles setting.
+
+        Raises:
+            ValueError if the section names an unknown ensemble."""
+        names = self._get_ensembles(options)
+        for name in names:
+            if name not in self._publishers:
+                raise ValueError('Unknown ZooKeeper ensemble: %s' % name)
+        if len(names) == 1:
+            return self._publishers[names[0]]
+        return Fanout([self._publishers[name] for name in names])
+
+    def _get_ensembles(self, options):
+        setting = options.get('zookeeper_ensembles')
+        if not setting:
+            return self._publishers.keys()
+        return [name.strip() for name in setting.split(',') if name.strip()]
 
     def _setup_watchers(self):
+        """Bring our watchers in line with the config.
+
+        Only sections whose settings changed since the last call are
+        touched; the others keep running undisturbed.
+
+        Returns:
+            The number of sections that were added, changed or removed."""
         # config中的配置信息
         # [memcache]
         # cmd: pgrep memcached
@@ -191,75 +539,174 @@ class WatcherDaemon(threading.Thread):
         # zookeeper_data: { "foo": "bar", "bar": "foo" }
         #
         # For each watcher, see if we already have one for a given path or not.
-        for service in self._config.sections():
-
-            # 1. 尽量复用以前的watcher
-            # service如: memcache, mysql等
-            watcher = self._get_watcher(service)
+        changed = 0
+        for service, (digest, options) in self._config.iteritems():
 
-            # Gather up the config data for our section into a few local
-            # variables so that we can shorten the statements below.
-            command = self._config.get(service, 'cmd')
-            service_port = self._config.get(service, 'service_port')
-            zookeeper_path = self._config.get(service, 'zookeeper_path')
-            refresh = self._config.get(service, 'refresh')
+            # Sections that did not change since we last saw them are left
+            # alone entirely.
+            if service in self._watchers and \
+                    self._sections.get(service, (None,))[0] == digest:
+                continue
 
-            # Gather our optional parameters. If they don't exist, set
-            # some reasonable default.
+            changed += 1
             try:
-                zookeeper_data = self._parse_data(self._config.get(service, 'zookeeper_data'))
-            except:
-                zookeeper_data = {}
-
-            try:
-                service_hostname = self._config.get(service, 'service_hostname')
-            except:
-                service_hostname = socket.getfqdn()
-
-            # 检查watcher的信息是否发生变化呢?
-            if watcher:
-                # Certain fields cannot be changed without destroying the
-                # object and its registration with Zookeeper.
-                if watcher._service_port != service_port or \
-                    watcher._service_hostname != service_hostname or \
-                        watcher._path != zookeeper_path:
-                    watcher.stop()
-                    watcher = None
-
-            # 2. 更新watcher的信息
-            if watcher:
-                # We already have a watcher for this service. Update its
-                # object data, and let it keep running.
-                watcher.set(command=command, data=zookeeper_data, refresh=refresh)
-
-            # If there's still no 'w' returned (either _get_watcher failed, or
-            # we noticed that certain un-updatable fields were changed, then
-            # create a new object.
-            if not watcher:
-                watcher = ServiceWatcher(registry=self._server_reg,
-                                   service=service,
-                                   service_port=service_port,
-                                   service_hostname=service_hostname,
-                                   command=command,
-                                   path=zookeeper_path,
-                                   data=zookeeper_data,
-                                   refresh=refresh)
-                self._watchers.append(watcher)
+                self._setup_watcher(service, options)
+            except Exception, e:
+                # One broken section must not keep the others from loading
+                self.log.error('Could not set up [%s]: %s' % (service, e))
+                continue
+            self._sections[service] = (digest, options)
 
         # Check if any watchers need to be destroyed because they're no longer
         # in our config.
         # 删除过期的watcher
-        for watcher in self._watchers:
-            if not watcher._service in list(self._config.sections()):
-                watcher.stop()
-                self._watchers.remove(watcher)
+        for service in self._watchers.keys():
+            if service not in self._config:
+                changed += 1
+                self._watchers.pop(service).stop()
+                self._sections.pop(service, None)
 
-    def _get_watcher(self, service):
-        """Returns a watcher based on the service name."""
-        for watcher in self._watchers:
-            if watcher._service == service:
-                return watcher
-        return None
+        return changed
+
+    def _setup_watcher(self, service, options):
+        """Create or update the watcher of a single config section.
+
+        Args:
+            service: (String) name of the section
+            options: (Dict) the settings of the section"""
+
+        # 1. 尽量复用以前的watcher
+        # service如: memcache, mysql等
+        watcher = self._watchers.get(service)
+
+        # Gather up the config data for our section into a few local
+        # variables so that we can shorten the statements below.
+        service_port = options['service_port']
+        ports = self._parse_ports(service_port)
+        if len(ports) > 1:
+            # A multi-instance section. {port} in its options stands for
+            # the port of each instance.
+            command = {}
+            for port in ports:
+                instance = dict((key, value.replace('{port}', port))
+                                for key, value in options.iteritems())
+                command[port] = self._get_check(instance, port) or \
+                    instance['cmd']
+        else:
+            command = self._get_check(options, service_port) or \
+                options['cmd']
+        zookeeper_path = options['zookeeper_path']
+        refresh = options['refresh']
+
+        # Gather our optional parameters. If they don't exist, set
+        # some reasonable default.
+        try:
+            zookeeper_data = self._parse_data(options['zookeeper_data'])
+        except:
+            zookeeper_data = {}
+
+        service_hostname = options.get('service_hostname') or \
+            socket.getfqdn()
+
+        # Settings that can be changed on a running watcher
+        settings = dict(
+            command=command,
+            data=zookeeper_data,
+            refresh=refresh,
+            rise=self._get_option(options, 'rise', 1),
+            fall=self._get_option(options, 'fall', 1),
+            flap_half_life=self._get_option(options, 'flap_half_life', 0),
+            min_refresh=self._get_option(options, 'min_refresh', None),
+            max_refresh=self._get_option(options, 'max_refresh', None),
+            dynamic_data=self._get_option(
+                options, 'dynamic_data', 'false').lower() in BOOLEAN_TRUE,
+            dynamic_data_interval=self._get_option(
+                options, 'dynamic_data_interval', 30),
+            dynamic_data_threshold=self._get_option(
+                options, 'dynamic_data_threshold', 10),
+            check_timeout=self._get_option(options, 'check_timeout', None),
+            pidfile=self._get_option(options, 'pidfile', None),
+            process=self._get_option(options, 'process', None))
+
+        # 检查watcher的信息是否发生变化呢?
+        if watcher:
+            # Certain fields cannot be changed without destroying the
+            # object and its registration with Zookeeper.
+            old_options = self._sections.get(service, (None, {}))[1]
+            if watcher._service_port != service_port or \
+                watcher._service_hostname != service_hostname or \
+                watcher._path != zookeeper_path or \
+                    self._get_ensembles(old_options) != \
+                    self._get_ensembles(options):
+                watcher.stop()
+                watcher = None
+
+        # 2. 更新watcher的信息
+        if watcher:
+            # We already have a watcher for this service. Update its
+            # object data, and let it keep running.
+            watcher.set(**settings)
+
+        # If there's still no 'w' returned (either there was no watcher, or
+        # we noticed that certain un-updatable fields were changed, then
+        # create a new object.
+        if not watcher:
+            if len(ports) > 1:
+                watcher_class = InstanceGroup
+            else:
+                watcher_class = ServiceWatcher
+            self._watchers[service] = watcher_class(
+                publisher=self._get_publisher(options),
+                scheduler=self._scheduler,
+                engine=self._checks,
+                service=service,
+                service_port=service_port,
+                service_hostname=service_hostname,
+                path=zookeeper_path,
+                reconcile=self._reconcile,
+                jitter=self._jitter,
+                fast_start=self._fast_start,
+                snapshot=self._snapshot,
+                restore_grace=self._restore_grace,
+                admission=self._admission,
+                monitor=self._monitor,
+                startup=self._startup_tracker,
+                **settings)
+
+    def _get_option(self, options, option, default):
+        """Returns an optional setting of a service, or its default."""
+        return options.get(option, default)
+
+    def _get_check(self, options, service_port):
+        """Returns the native check configured for a service.
+
+        Returns None if the section uses a 'cmd' instead."""
+        check_type = options.get('check', 'cmd')
+        if check_type == 'cmd':
+            return None
+
+        return checks.get_check(check_type, options, service_port)
+
+    def _parse_ports(self, ports):
+        """Convert a service_port setting into a list of ports.
+
+        Besides a single port, a multi-instance section can list several
+        ports and ranges of ports:
+
+            service_port: 11211-11242
+            service_port: 6379, 6380, 7000-7003
+
+        Raises:
+            ValueError if ports is not a valid list of ports."""
+        result = []
+        for part in ports.split(','):
+            first, _, last = part.strip().partition('-')
+            for port in xrange(int(first), int(last or first) + 1):
+                if str(port) not in result:
+                    result.append(str(port))
+        if not result:
+            raise ValueError('No ports in %r' % ports)
+        return result
 
     def _parse_data(self, data):
         """Convert a string of data from ConfigParse into our dict.
@@ -289,97 +736,781 @@ class WatcherDaemon(threading.Thread):
     def run(self):
         """Start up all of the worker threads and keep an eye on them"""
 
+        if self._metrics_server:
+            metrics.add_collector(self._collect_metrics)
+            self._metrics_server.start()
+        if self._admin_server:
+            self._admin_server.start()
+
+        for publisher in self._publishers.values():
+            publisher.start()
+        self._scheduler.start()
+        self._engine.start()
+        self._monitor.start()
         self._setup_watchers()
-
-        # Now, loop. Wait for a death signal
-        while True and not self._event.is_set():
-            self._event.wait(1)
-
-        # At this point we must be exiting. Kill off our above threads
-        for w in self._watchers:
+        self._startup.mark('setup')
+        self._startup_tracker.arm()
+        self._scheduler.schedule((self, 'startup'), STARTUP_TIMEOUT,
+                                 self._startup_overdue)
+        if self._snapshot:
+            # Nodes of services we no longer have are not coming back
+            self._snapshot.discard_restorable()
+        if self._config_watcher:
+            self._config_watcher.start()
+        if self._watchdog_multiple:
+            self._watchdog = Watchdog(self._watchers.values,
+                                      self._publishers.values(),
+                                      self._watchdog_multiple,
+                                      restart=self._reconnect)
+            self._watchdog.start()
+
+        # Now, loop. Wait for a death signal, and do the reloads and dumps
+        # we're asked for in the meantime.
+        while not self._event.is_set():
+            commands = [self._commands.get()]
+
+            # A burst of requests only needs to be handled once
+            while True:
+                try:
+                    commands.append(self._commands.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if 'reload' in commands:
+                try:
+                    self._reload()
+                except Exception, e:
+                    self.log.exception('Config reload failed: %s' % e)
+            if 'dump' in commands:
+                try:
+                    self._dump()
+                except Exception, e:
+                    self.log.exception('Diagnostics dump failed: %s' % e)
+
+        # At this point we must be exiting. Keep the snapshot as it is, so we
+        # can restore from it when we're back.
+        if self._snapshot:
+            self._snapshot.close()
+
+        # Kill off our above threads
+        if self._watchdog:
+            self._watchdog.stop()
+        for w in self._watchers.values():
             w.stop()
 
+        # Let the workers finish de-registering the watchers above, then exit
+        self._monitor.stop()
+        self._engine.stop()
+        self._scheduler.stop()
+        for publisher in self._publishers.values():
+            publisher.stop()
+
     def stop(self):
         self._event.set()
+        self._commands.put('stop')
+
+    def _dump(self):
+        """Dump our threads, watchers and running checks."""
+        now = time.time()
+        lines = ['zk_watcher %s diagnostics, pid %s, %s' %
+                 (VERSION, os.getpid(), time.ctime(now))]
+
+        lines.append('')
+        lines.append('Watchers:')
+        for service in sorted(self._watchers):
+            lines.append('  [%s] %s' % (
+                service, self._watchers[service].diagnostics()))
+
+        lines.append('')
+        lines.append('ZooKeeper ensembles:')
+        for name, publisher in self._publishers.iteritems():
+            lines.append('  [%s] %s: %s' % (name, self._servers[name],
+                                            publisher.diagnostics()))
+
+        lines.append('')
+        lines.append('Running checks:')
+        for service, command, pid, age in sorted(self._checks.in_flight()):
+            lines.append('  [%s] pid %s, running %.3fs: %s' %
+                         (service, pid, age, command))
+
+        lines.append('')
+        lines.extend(thread_stacks())
+
+        name = 'zk_watcher-%s-%d' % (os.getpid(), now)
+        if self._dump_dir:
+            path = os.path.join(self._dump_dir, name + '.txt')
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.log.warning('Wrote diagnostics to %s' % path)
+        else:
+            self.log.warning('\n'.join(lines))
+
+        if self._profile:
+            directory = self._dump_dir or tempfile.gettempdir()
+            Sampler(self._profile,
+                    os.path.join(directory, name + '.profile')).start()
+
+    def _startup_reached(self, milestone):
+        """Called by the StartupTracker once every watcher has reached a
+        milestone. Logs how long it all took once they have reached both."""
+        if self._event.is_set():
+            # Stopping forgets every watcher; that is no milestone
+            return
+        metrics.set_gauge('zk_watcher_startup_seconds',
+                          self._startup.mark(milestone), milestone=milestone)
+
+        reached = [name for name, _ in self._startup.milestones]
+        if 'first checks' in reached and 'first publish' in reached:
+            self._scheduler.cancel((self, 'startup'))
+            self.log.info('Checked and published %d services, %s since the '
+                          'process started' % (len(self._watchers),
+                                               self._startup.format()))
+
+    def _startup_overdue(self):
+        if self._event.is_set() or self._startup_tracker.done:
+            return
+        self.log.warning('Not every service has been checked and published '
+                         '%ss after startup: %s' %
+                         (STARTUP_TIMEOUT, self._startup.format()))
+
+    def _admin(self, command, args):
+        """Carry out a command from the admin socket.
 
-
-class ServiceWatcher(threading.Thread):
-    """Monitors a particular service definition."""
+        Args:
+            command: (String) drain, undrain, check or status
+            args: (List) the services to apply it to, all of them if empty
+
+        Returns:
+            A dict to send back.
+
+        Raises:
+            AdminError if the command or one of the services is unknown."""
+        if command not in ('drain', 'undrain', 'check', 'status'):
+            raise AdminError('Unknown command: %s' % command)
+
+        watchers = {}
+        for service in args or self._watchers.keys():
+            watcher = self._watchers.get(service)
+            if watcher is None:
+                raise AdminError('Unknown service: %s' % service)
+            watchers[service] = watcher
+
+        if command == 'status':
+            return {'services': dict((service, watcher.status())
+                                     for service, watcher in
+                                     watchers.iteritems())}
+        if command == 'check':
+            for watcher in watchers.values():
+                watcher.check()
+            return {}
+        if command == 'undrain':
+            for watcher in watchers.values():
+                watcher.undrain()
+            return {}
+
+        # Answer once ZooKeeper has confirmed every de-registration, so that
+        # a deploy script knows it is safe to go ahead
+        events = dict((service, threading.Event()) for service in watchers)
+        committed = dict.fromkeys(watchers, False)
+
+        def done(service, success):
+            committed[service] = success
+            events[service].set()
+
+        for service, watcher in watchers.iteritems():
+            watcher.drain(functools.partial(done, service))
+        deadline = time.time() + DRAIN_TIMEOUT
+        for event in events.values():
+            event.wait(max(deadline - time.time(), 0))
+        return {'committed': committed}
+
+    def _collect_metrics(self):
+        metrics.set_gauge('zk_watcher_threads', threading.active_count())
+
+
+class ServiceWatcher(object):
+    """Monitors a particular service definition.
+
+    The watcher does not own a thread. Its checks are run by the shared
+    Scheduler, and each check schedules the next one once it has finished,
+    so a slow check is never stacked on top of itself."""
 
     LOGGER = 'WatcherDaemon.ServiceWatcher'
 
-    def __init__(self, registry, service, service_port, command, path, data,
-                 service_hostname, refresh=15):
-        """Initialize the object and begin monitoring the service."""
-        # Initiate our thread
-        super(ServiceWatcher, self).__init__()
-
-        self._server_reg = registry
+    def __init__(self, publisher, scheduler, engine, service, service_port,
+                 command, path, data, service_hostname, refresh=15,
+                 reconcile=RECONCILE, jitter=0, fast_start=False,
+                 snapshot=None, restore_grace=0, owner=None, admission=None,
+                 monitor=None, startup=None, **kwargs):
+        """Initialize the object and begin monitoring the service.
+
+        A watcher with an owner (an InstanceGroup) is driven: it does not
+        schedule checks of its own. The owner runs them, and hands it the
+        results with report().
+        Otherwise each check waits for room in the admission controller
+        (limits.Admission), if given.
+
+        With a monitor (procwatch.ProcessMonitor), the process of the service
+        can be watched as well (see the pidfile and process settings).
+
+        If the snapshot has our node as healthy from the previous run (and
+        restore_grace is set), it is republished right away. The first check
+        then has restore_grace seconds to confirm it.
+
+        Our first check and first publish are reported to the startup
+        tracker (diagnostics.StartupTracker), if given."""
+        self._publisher = publisher
+        self._scheduler = scheduler
+        self._engine = engine
         self._service = service
         self._service_port = service_port
         self._service_hostname = service_hostname
         self._path = path
         self._fullpath = '%s/%s:%s' % (path, service_hostname, service_port)
-        self.set(command, data, refresh)
-        self.log = logging.getLogger('%s.%s' % (self.LOGGER, self._service))
+        self.log = logpipe.per_service(
+            logging.getLogger('%s.%s' % (self.LOGGER, self._service)))
         self.log.debug('Initializing...')
 
+        # _lock protects the scheduling state below. _publish_lock orders
+        # our registry updates against the final unset() in stop().
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
         self._event = threading.Event()
-        self.setDaemon(True)
-        self.start()
+        self._owner = owner
+        self._driven = owner is not None
+        self._admission = admission
+        self._monitor = monitor
+        self._startup = startup
+        if startup:
+            startup.add(self)
+        self._running = False
+        self._last_checked = 0
+        self._due = 0
+        self._started = 0
+
+        # Whether our last check passed, whether we have been drained (see
+        # drain()), and whether the next check must publish even if nothing
+        # changed (see check())
+        self._passing = None
+        self._drained = False
+        self._force = False
+
+        # Bumped by expire() when the Watchdog gives up on a check, so that
+        # its result is ignored if it ever comes in
+        self._generation = 0
+
+        # Whether our check is waiting for the admission controller, and
+        # the run holding our slot of it, if any (see _release())
+        self._queued = False
+        self._slot = None
+
+        # Each path checks at its own fixed point (phase) within the refresh
+        # interval, derived from the path itself. Hosts that were restarted
+        # at the same time then still spread their writes evenly instead of
+        # all hitting ZooKeeper at once.
+        self._phase = (zlib.crc32(self._fullpath) & 0xffffffff) / 2.0 ** 32
+        self._jitter = jitter
+        self._refresh = None
+        self._min_refresh = None
+        self._max_refresh = None
+
+        # The current check interval, which only differs from refresh when
+        # min_refresh or max_refresh are set. See _adapt().
+        self._interval = None
+        self._last_result = None
+
+        # The last (state, data) we successfully wrote to ZooKeeper. We only
+        # write again when it changes, or every `reconcile` seconds to make
+        # up for nodes that were lost or deleted behind our back.
+        self._reconcile = reconcile
+        self._published = None
+        self._last_published = 0
+        self._writes = 0
+        self._suppressed = 0
+
+        # Timings of our checks and of our updates going through the
+        # Publisher, for the SIGUSR1 diagnostics dump
+        self._check_times = TimingStats()
+        self._publish_times = TimingStats()
+        self._lag = 0
+
+        # Checks that took longer than our interval, and the runs we skipped
+        # because of them
+        self._overruns = 0
+        self._skipped = 0
+
+        # Turns our raw check results into the state we publish, and the
+        # output of our check into data (with dynamic_data)
+        self._filter = StateFilter(service)
+        self._data_filter = None
+
+        # Where we record what we published, and whether our node is
+        # currently one restored from it that no check has confirmed yet
+        self._snapshot = snapshot
+        self._restored = False
+
+        self.set(command, data, refresh, **kwargs)
+
+        restored = None
+        if snapshot and restore_grace:
+            restored = snapshot.restore(self._fullpath)
+        if restored is not None:
+            self._restore(restored, restore_grace)
+        elif fast_start:
+            self._schedule(0)
+        else:
+            self._schedule(self._next_delay())
 
-    def set(self, command, data, refresh):
+    def set(self, command, data, refresh, rise=1, fall=1, flap_half_life=0,
+            min_refresh=None, max_refresh=None, dynamic_data=False,
+            dynamic_data_interval=30, dynamic_data_threshold=10,
+            check_timeout=None, pidfile=None, process=None):
         """Public method for re-configuring our service checks.
 
         NOTE: You cannot re-configure the port or server-name currently.
 
         Args:
-            command: (String) command to execute
+            command: (String/Check) command or native check to execute
             data: (String/Dict) configuration data to pass with registration
-            refresh: (Int) frequency (in seconds) of check"""
+            refresh: (Int) frequency (in seconds) of check
+            rise: (Int) passing checks in a row before we register
+            fall: (Int) failing checks in a row before we de-register
+            flap_half_life: (Int) flap damping half-life in seconds, or 0
+            min_refresh: (Int) check interval right after a failure or a
+                         change of state (default: refresh)
+            max_refresh: (Int) check interval the service backs off to
+                         while it is stable and healthy (default: refresh)
+            dynamic_data: (Boolean) merge the fields the check command
+                          prints into our data (see dynamic.py)
+            dynamic_data_interval: (Float) publish changed fields at most
+                                   this often (seconds)
+            dynamic_data_threshold: (Float) percentage a numeric field has to
+                                    change by to be published
+            check_timeout: (Float) seconds before a check command is killed
+                           (default: CHECK_TIMEOUT)
+            pidfile: (String) pidfile of the process of the service, which
+                     takes our node down the moment it exits
+            process: (String) or a regular expression matching the command
+                     line of that process. {port} in either of them stands
+                     for our port."""
+
+        refresh = int(refresh)
+        min_refresh = min(int(min_refresh or refresh), refresh)
+        max_refresh = max(int(max_refresh or refresh), refresh)
+
+        with self._publish_lock:
+            self._filter.configure(rise, fall, flap_half_life)
+            if not dynamic_data or isinstance(command, checks.Check):
+                self._data_filter = None
+            elif self._data_filter is None:
+                self._data_filter = DataFilter(dynamic_data_interval,
+                                               dynamic_data_threshold)
+            else:
+                self._data_filter.configure(dynamic_data_interval,
+                                            dynamic_data_threshold)
+
+        with self._lock:
+            changed = self._refresh is not None and \
+                (self._refresh, self._min_refresh, self._max_refresh) != \
+                (refresh, min_refresh, max_refresh)
+            self._command = command
+            self._timeout = float(check_timeout or CHECK_TIMEOUT)
+            self._refresh = refresh
+            self._min_refresh = min_refresh
+            self._max_refresh = max_refresh
+            self._data = data
+            if self._interval is None or changed:
+                self._interval = refresh
+
+            # Let the CheckCache know how fresh we need our results to be
+            if isinstance(command, checks.Check):
+                self._engine.unsubscribe(self)
+            elif not self._event.is_set():
+                self._engine.subscribe(self, command, min_refresh,
+                                       output=self._data_filter is not None)
+
+            # A check in flight will pick up the new refresh when it
+            # reschedules itself. Otherwise move our pending deadline.
+            if changed and not self._running and not self._event.is_set():
+                self._schedule(self._next_delay())
+
+        if self._monitor and not self._event.is_set():
+            port = str(self._service_port)
+            if pidfile or process:
+                self._monitor.watch(
+                    self,
+                    pidfile=pidfile and pidfile.replace('{port}', port),
+                    pattern=process and process.replace('{port}', port),
+                    callback=self._process_exited)
+            else:
+                self._monitor.unwatch(self)
+
+    def _restore(self, data, grace):
+        """Republish our node from the snapshot, and confirm it soon."""
+        self.log.info('Restoring %s from snapshot, confirming within %ss' %
+                      (self._fullpath, grace))
+        with self._publish_lock:
+            self._restored = True
+            self._filter.assume(True)
+            self._write(True, data, time.time())
+        self._schedule(0)
+        self._scheduler.schedule((self, 'grace'), grace, self._grace_expired)
+
+    def _grace_expired(self):
+        with self._publish_lock:
+            if self._event.is_set() or not self._restored:
+                return
+            self.log.warning('Restored node %s was not confirmed in time, '
+                             'withdrawing it' % self._fullpath)
+            self._restored = False
+            self._filter.assume(None)
+            self._update(state=False)
+
+    def _schedule(self, delay):
+        """Schedules our next check in delay seconds."""
+        if self._driven:
+            return
+        self._due = time.time() + delay
+        self._scheduler.schedule(self, delay, self._check)
+
+    def _next_delay(self):
+        """Returns the number of seconds until our next check.
+
+        That is the next time our phase comes around in the refresh
+        interval, plus some random jitter if configured."""
+        refresh = max(self._interval, 1)
+        delay = refresh - (time.time() - self._phase * refresh) % refresh
+        if self._jitter:
+            delay += random.uniform(0, self._jitter)
+        return delay
+
+    def _check(self):
+        """Starts a single service check.
+
+        Called from a Scheduler worker thread. The check itself starts once
+        the admission controller has room for it."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._running = True
+            self._queued = bool(self._admission)
+            start = functools.partial(self._start, self._generation)
+
+        if self._admission:
+            self._admission.submit(start, key=self)
+        else:
+            start()
+
+    def _start(self, generation):
+        """Runs our check. The engine calls _finish() once it is done."""
+        with self._lock:
+            self._queued = False
+            if self._event.is_set() or generation != self._generation:
+                if generation == self._generation:
+                    self._running = False
+                if self._admission:
+                    self._admission.release()
+                return
+            command = self._command
+            fresh = self._force
+            slot = self._slot = object()
+            self._started = time.time()
+            self._lag = max(self._started - self._due, 0)
+            metrics.observe('zk_watcher_schedule_lag_seconds', self._lag,
+                            service=self._service)
+
+        self.log.debug('[%s] running', command)
+
+        # First, run our service check command and see what the
+        # return code is. Native checks run right here in the worker.
+        try:
+            if not isinstance(command, checks.Check):
+                shared = self._engine.execute(
+                    command, self._service, self._timeout,
+                    functools.partial(self._finish, command,
+                                      generation=generation, slot=slot),
+                    output=self._data_filter is not None, fresh=fresh,
+                    key=self)
+                if shared:
+                    # We are waiting for another watcher's run, which holds
+                    # a slot of its own
+                    self._release(slot)
+                return
+            ret = command.run()
+        except Exception, e:
+            self.log.error('[%s] could not be run: %s', command, e)
+            ret = 1
+        self._finish(command, ret, generation=generation, slot=slot)
+
+    def _release(self, slot):
+        """Gives back our slot of the admission controller, if slot (a run)
+        still holds it."""
+        with self._lock:
+            if slot is None or slot is not self._slot:
+                return
+            self._slot = None
+        if self._admission:
+            self._admission.release()
+
+    def report(self, ret, started, output=None):
+        """Publishes the result of a check our owner ran for us.
 
-        self._command = command
-        self._refresh = int(refresh)
-        self._data = data
+        Args:
+            ret: (Int) exit code of the check
+            started: (Float) when the check was started
+            output: (String) output of the check, with dynamic_data"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._running = True
+            self._started = started
+        self._finish(self._command, ret, output)
+
+    def _finish(self, command, ret, output=None, generation=None,
+                slot=None):
+        """Publishes the result of a check and schedules the next one."""
+        if generation is not None and generation != self._generation:
+            # The Watchdog has given up on this check (and released its
+            # slot) already
+            self.log.warning('[%s] finished after all, ignoring its result',
+                             command)
+            return
+
+        duration = time.time() - self._started
+        self._check_times.record(duration)
+        metrics.observe('zk_watcher_check_duration_seconds', duration,
+                        service=self._service)
+        if ret != 0:
+            metrics.inc('zk_watcher_check_failures_total',
+                        service=self._service)
+
+        # Checks are never stacked on top of each other, so a check that
+        # runs longer than our interval means we skipped runs.
+        interval = max(self._interval, 1)
+        if duration > interval and not self._driven:
+            skipped = int(duration // interval)
+            self._overruns += 1
+            self._skipped += skipped
+            metrics.inc('zk_watcher_check_overruns_total',
+                        service=self._service)
+            metrics.inc('zk_watcher_check_runs_skipped_total', skipped,
+                        service=self._service)
+            self.log.warning('[%s] took %.1fs, longer than our interval of '
+                             '%ss', command, duration, interval)
 
-    def run(self):
-        """Monitors the supplied service, and keeps it registered.
-
-        We loop every second, checking whether or not we need to run our
-        check. If we do, we run the check. If we don't, we wait until
-        we need to, or we receive a stop."""
-
-        last_checked = 0
-        self.log.debug('Beginning run() loop')
-        while True and not self._event.is_set():
-            # 以_refresh间隔来做检查
-            if time.time() - last_checked > self._refresh:
-                self.log.debug('[%s] running' % self._command)
-
-                # First, run our service check command and see what the
-                # return code is
-                c = Command(self._command, self._service)
-                ret = c.run(timeout=90)
-
-                if ret == 0:
-                    # If the command was successfull...
-                    self.log.debug('[%s] returned successfull' % self._command)
-                    self._update(state=True)
-                else:
-                    # If the command failed...
-                    self.log.warning('[%s] returned a failed exit code [%s]' %
-                                     (self._command, ret))
-                    self._update(state=False)
-
-                # Now that our service check is done, update our lastrun{}
-                # array with the current time, so that we can check how
-                # long its been since the last run.
-                last_checked = time.time()
-
-            # Sleep for one second just so that we dont run in a crazy loop
-            # taking up all kinds of resources.
-            self._event.wait(1)
+        try:
+            with self._publish_lock:
+                if not self._event.is_set():
+                    if ret == 0:
+                        # If the command was successfull...
+                        self.log.debug('[%s] returned successfull', command)
+                    else:
+                        # If the command failed...
+                        self.log.warning(
+                            '[%s] returned a failed exit code [%s]',
+                            command, ret)
+
+                    # Only change our registration once the result is
+                    # stable (see the rise, fall and flap_half_life options)
+                    state = self._filter.update(ret == 0)
+                    if state != (ret == 0):
+                        self.log.debug('Holding state %s', state)
+                    self._passing = ret == 0
+                    if ret == 0 and self._monitor:
+                        # Our process is evidently running; watch it if we
+                        # aren't already
+                        self._monitor.arm(self)
+                    if ret == 0:
+                        self._restored = False
+                    if ret == 0 and output is not None and self._data_filter:
+                        if self._data_filter.update(parse_output(output)):
+                            self.log.debug('Reported data changed: %s',
+                                           self._data_filter.fields)
+                    force, self._force = self._force, False
+                    self._update(state=state, force=force)
+        finally:
+            # Now that our service check is done, record the time and
+            # schedule the next run.
+            with self._lock:
+                self._running = False
+                self._last_checked = time.time()
+                self._adapt(ret == 0)
+                if not self._event.is_set():
+                    self._schedule(self._next_delay())
+            self._release(slot)
+            if self._startup:
+                self._startup.reached(self, 'first checks')
+
+    def _adapt(self, result):
+        """Adjust our check interval to the latest check result.
+
+        A failure, or any change of result, drops the interval to
+        min_refresh so that we find out quickly whether it sticks. Every
+        passing check after that stretches it by REFRESH_GROWTH, up to
+        max_refresh. Must be called with self._lock held."""
+        if self._min_refresh == self._max_refresh:
+            return
+
+        if not result or result != self._last_result:
+            self._interval = self._min_refresh
+        else:
+            self._interval = min(self._interval * REFRESH_GROWTH,
+                                 self._max_refresh)
+        self._last_result = result
+        metrics.set_gauge('zk_watcher_check_interval_seconds',
+                          self._interval, service=self._service)
+
+    def _process_exited(self, pid):
+        """Called by the ProcessMonitor when the process we watch exits.
+
+        Takes our node down right away. A check confirms it as soon as
+        possible, and our checks decide about the node from then on."""
+        with self._publish_lock:
+            if self._event.is_set():
+                return
+            self.log.warning('Process %s exited, de-registering %s' %
+                             (pid, self._fullpath))
+            metrics.inc('zk_watcher_process_exits_total',
+                        service=self._service)
+            self._filter.assume(False)
+            self._restored = False
+            if self._published is None or self._published[0]:
+                self._write(False, self._node_data(), time.time(),
+                            urgent=True)
+        self.check()
+
+    def drain(self, callback=None):
+        """Take our node out of service right away, regardless of checks.
+
+        The node stays de-registered until undrain(). Our checks keep
+        running in the meantime, so status() still tells whether the service
+        is healthy.
+
+        Args:
+            callback: (Callable) called with True or False once the
+                      de-registration has been committed (or has failed)"""
+        with self._publish_lock:
+            if self._event.is_set():
+                if callback:
+                    callback(False)
+                return
+            self.log.warning('Draining %s' % self._fullpath)
+            self._drained = True
+            self._restored = False
+            self._write(False, self._node_data(), time.time(), urgent=True,
+                        callback=callback)
+
+    def undrain(self):
+        """Let our checks decide about our node again, starting now."""
+        with self._publish_lock:
+            if not self._drained:
+                return
+            self.log.warning('Undraining %s' % self._fullpath)
+            self._drained = False
+        self.check()
+
+    def check(self):
+        """Check the service right away, and publish the result.
+
+        The check is not answered from the CheckCache, and its result is
+        written to ZooKeeper even if it did not change. If a check is
+        already running, its result is published that way.
+
+        A driven watcher has its owner run the check."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._force = True
+            if not self._running:
+                self._schedule(0)
+        if self._owner:
+            self._owner.wake()
+
+    def overdue(self, now, multiple):
+        """Whether our next check is more than multiple intervals late.
+
+        That means a check is stuck somewhere: waiting for a worker, in the
+        engine, or on its way to ZooKeeper. A check waiting for admission is
+        only held up by the others, which are expired themselves if they
+        get stuck; restarting it would only put it back in line."""
+        if self._driven or self._event.is_set():
+            return False
+        with self._lock:
+            if self._queued:
+                return False
+            since = max(self._due, self._started)
+            return now - since > multiple * max(self._interval, 1)
+
+    def expire(self):
+        """Give up on our overdue check (see the Watchdog).
+
+        Our node is taken down, since we can no longer vouch for it, and the
+        command is started anew, bypassing the CheckCache. The stuck run is
+        killed (unless other watchers share it), gives up its admission slot
+        right away, and is ignored if it ever finishes. A check that is still
+        waiting for admission keeps its place in line instead."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            late = time.time() - self._due
+            self._generation += 1
+            self._running = False
+            self._force = True
+        self._release(self._slot)
+        self._engine.cancel(self)
+        self.log.error('No check finished for %.1fs (running %s), restarting '
+                       'checks' % (late, self._command))
+        metrics.inc('zk_watcher_watchdog_expired_total', service=self._service)
+        self._withdraw()
+        with self._lock:
+            if not self._event.is_set():
+                self._schedule(0)
+
+    def _withdraw(self):
+        """Take our node down right away until a check says otherwise."""
+        with self._publish_lock:
+            if self._event.is_set():
+                return
+            self._filter.assume(None)
+            self._restored = False
+            if self._published and self._published[0]:
+                self._write(False, self._node_data(), time.time(),
+                            urgent=True)
+
+    def status(self):
+        """Returns our current state, as a dict."""
+        with self._lock:
+            published = self._published
+            return {
+                'path': self._fullpath,
+                'registered': bool(published and published[0]),
+                'data': published and published[1],
+                'passing': self._passing,
+                'drained': self._drained,
+                'restored': self._restored,
+                'running': self._running,
+                'interval': self._interval,
+                'last_checked': self._last_checked or None,
+                'pid': self._monitor and self._monitor.pid(self),
+            }
 
+    def stop(self):
+        """Stop checking the service and de-register it.
+
+        The de-registration itself is handed off to the Scheduler's workers
+        so that the caller is not blocked on ZooKeeper."""
+        with self._lock:
+            self._event.set()
+            self._scheduler.cancel(self)
+            self._scheduler.cancel((self, 'grace'))
+            self._engine.unsubscribe(self)
+        if self._monitor:
+            self._monitor.unwatch(self)
+        if self._startup:
+            self._startup.forget(self)
+        self._scheduler.submit(self._teardown)
+
+    def _teardown(self):
         # watcher一挂似乎对应的服务也挂了，这个是一个大风险呀!
         # 1. 这个地方可能需要注意，例如: 如果我们监控MySQL或Redis等，如果监控服务挂了，主服务就暂时不要停止
         # 2. 如果整个机器挂了，那么如何做到监控呢?
@@ -388,27 +1519,393 @@ class ServiceWatcher(threading.Thread):
         #
         #      online_medweb/service/mysql/mysql2
         #      online_medweb/service/mysql/mysql3
-        self._update(False)
-        self._server_reg.unset(self._fullpath)
-        self._server_reg = None
-        self.log.debug('Watcher %s is exiting the run() loop.' % self._service)
+        with self._publish_lock:
+            self._publisher.unset(self._fullpath)
+        if self._snapshot:
+            self._snapshot.remove(self._fullpath)
+        metrics.remove(service=self._service)
+        self.log.debug('Watcher %s has stopped.' % self._service)
+
+    def diagnostics(self):
+        """Returns a one line summary of our state and timings."""
+        published = self._published and self._published[0]
+        return ('path %s, registered %s, every %ss, lag %.3fs, running %s, '
+                'check: %s, set_node: %s, %d writes, %d suppressed, '
+                '%d overruns, %d runs skipped' % (
+                    self._fullpath, published, self._interval, self._lag,
+                    self._running, self._check_times.format(),
+                    self._publish_times.format(), self._writes,
+                    self._suppressed, self._overruns, self._skipped))
+
+    def _update(self, state, force=False):
+        # A drained node stays down whatever the checks say
+        if self._drained:
+            state = False
+
+        # Skip the write if ZooKeeper already has exactly this state and
+        # data, unless it's time to reconcile.
+        now = time.time()
+        data = self._node_data()
+        if not force and self._published == (state, data):
+            if now - self._last_published < self._reconcile:
+                self._suppressed += 1
+                metrics.inc('zk_watcher_writes_suppressed_total',
+                            service=self._service)
+                self.log.debug('[%s] state %s unchanged, skipping update',
+                               self._service, state)
+                return True
+            self.log.debug('[%s] reconciling path %s (%s writes suppressed '
+                           'so far)', self._service, self._fullpath,
+                           self._suppressed)
+
+        self.log.debug('Attempting to update service [%s] with data [%s], '
+                       'and state [%s].', self._service, data, state)
+        self._write(state, data, now)
+        return True
+
+    def _node_data(self):
+        """Returns our configured data, plus any the check reported."""
+        if not self._data_filter or not self._data_filter.fields:
+            return self._data
+        data = dict(self._data)
+        data.update(self._data_filter.fields)
+        return data
+
+    def _write(self, state, data, now, urgent=False, callback=None):
+        """Hand our state, data and path information to the Publisher.
+
+        It batches the update with those of the other watchers (unless it is
+        urgent) and lets us know how it went in _on_publish(), which passes
+        that on to callback. Must be called with self._publish_lock held."""
+        published = (state, copy.deepcopy(data))
+        self._published = published
+        self._last_published = now
+        self._writes += 1
+        metrics.inc('zk_watcher_writes_total', service=self._service)
+        self._publisher.set_node(self._fullpath, published[1], state,
+                                 callback=functools.partial(self._on_publish,
+                                                            published, now,
+                                                            done=callback),
+                                 urgent=urgent)
+
+    def _on_publish(self, published, queued, success, done=None):
+        """Called by the Publisher once our update has been committed."""
+        if done:
+            done(success)
+        state = published[0]
+        self._publish_times.record(time.time() - queued)
+        metrics.observe('zk_watcher_publish_seconds', time.time() - queued,
+                        service=self._service)
+        if success:
+            if self._startup:
+                self._startup.reached(self, 'first publish')
+            self.log.debug('[%s] sucessfully updated path %s with state %s',
+                           self._service, self._fullpath, state)
+            metrics.set_gauge('zk_watcher_registered', int(bool(state)),
+                              service=self._service)
+            if self._snapshot and not self._event.is_set():
+                self._snapshot.record(self._fullpath, state, published[1])
+            return
+
+        metrics.inc('zk_watcher_publish_failures_total', service=self._service)
+        self.log.warn('[%s] could not update path %s with state %s',
+                      self._service, self._fullpath, state)
+        # Make sure the next check writes it again
+        with self._publish_lock:
+            if self._published is published:
+                self._published = None
+
+
+class InstanceGroup(object):
+    """Monitors every instance (port) of a multi-instance section.
+
+    Each instance gets a driven ServiceWatcher of its own, which keeps its
+    own state and registration. The group runs the checks of all of them
+    from a single scheduler entry, in one pass: native checks together (see
+    checks.run_all()), commands all at once through the engine, where the
+    CheckCache collapses the ones that are identical."""
+
+    LOGGER = 'WatcherDaemon.InstanceGroup'
+
+    def __init__(self, publisher, scheduler, engine, service, service_port,
+                 command, path, data, service_hostname, refresh=15,
+                 jitter=0, fast_start=False, admission=None, **kwargs):
+        """Initialize the object and begin monitoring the instances.
+
+        Takes the same arguments as a ServiceWatcher, except that
+        service_port is the port list of the section, and command a dict of
+        port -> command (or native check) of each instance. A pass over all
+        of the instances takes a single slot of the admission controller."""
+        self._scheduler = scheduler
+        self._engine = engine
+        self._admission = admission
+        self._service = service
+        self._service_port = service_port
+        self._service_hostname = service_hostname
+        self._path = path
+        self.log = logpipe.per_service(
+            logging.getLogger('%s.%s' % (self.LOGGER, self._service)))
 
-    def stop(self):
-        """Stop the run() loop."""
-        self._event.set()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._running = False
+        self._due = 0
+        self._lag = 0
+        self._jitter = jitter
+        self._refresh = int(refresh)
 
-    def _update(self, state):
-        # Call ServiceRegistry.set() method with our state, data,
-        # path information. The ServiceRegistry module will take care of
-        # updating the data, state, etc.
-        self.log.debug('Attempting to update service [%s] with data [%s], and state [%s].' % (self._service, self._data, state))
-        try:
-            self._server_reg.set_node(self._fullpath, self._data, state)
-            self.log.debug('[%s] sucessfully updated path %s with state %s' % (self._service, self._fullpath, state))
-            return True
-        except exceptions.NoConnection, e:
-            self.log.warn('[%s] could not update path %s with state %s: %s' % (self._service, self._fullpath, state, e))
+        # Each pass over the instances is known by the time it started.
+        # _pending counts the instances each pass still waits for, usually
+        # just the current pass, unless the Watchdog gave up on one (see
+        # expire()).
+        self._pass = None
+        self._pending = {}
+        self._generation = 0
+
+        # Whether our pass is waiting for the admission controller, and
+        # the pass holding our slot of it, if any
+        self._queued = False
+        self._slot = None
+
+        # Whether an instance asked for a check while a pass was running,
+        # so that another one follows right away (see wake())
+        self._again = False
+        self._phase = (zlib.crc32('%s/%s:%s' % (path, service_hostname,
+                                                service_port))
+                       & 0xffffffff) / 2.0 ** 32
+
+        self._watchers = []
+        for port in sorted(command, key=int):
+            self._watchers.append((port, ServiceWatcher(
+                publisher=publisher,
+                scheduler=scheduler,
+                engine=engine,
+                service='%s:%s' % (service, port),
+                service_port=port,
+                command=command[port],
+                path=path,
+                data=data,
+                service_hostname=service_hostname,
+                refresh=refresh,
+                owner=self,
+                **kwargs)))
+        self.log.debug('Watching %d instances' % len(self._watchers))
+
+        # Confirm instances restored from the snapshot right away
+        restored = [w for _, w in self._watchers if w._restored]
+        if fast_start or restored:
+            self._schedule(0)
+        else:
+            self._schedule(self._next_delay())
+
+    def set(self, command, data, refresh, **kwargs):
+        """Re-configure the instances. See ServiceWatcher.set()."""
+        for port, watcher in self._watchers:
+            watcher.set(command[port], data, refresh, **kwargs)
+
+        with self._lock:
+            changed = self._refresh != int(refresh)
+            self._refresh = int(refresh)
+            if changed and not self._running and not self._event.is_set():
+                self._schedule(self._next_delay())
+
+    def drain(self, callback=None):
+        """Drain every instance. See ServiceWatcher.drain().
+
+        callback is called once, when all of the instances are done."""
+        results = []
+        lock = threading.Lock()
+
+        def done(success):
+            with lock:
+                results.append(success)
+                finished = len(results) == len(self._watchers)
+            if finished and callback:
+                callback(all(results))
+
+        for _, watcher in self._watchers:
+            watcher.drain(done)
+
+    def undrain(self):
+        """Undrain every instance, and check them right away."""
+        for _, watcher in self._watchers:
+            watcher.undrain()
+        self.check()
+
+    def check(self):
+        """Check every instance right away. See ServiceWatcher.check()."""
+        for _, watcher in self._watchers:
+            watcher.check()
+
+    def wake(self):
+        """Run a pass right away, for an instance whose check() was called.
+
+        If a pass is running, the instance may well have been checked by it
+        already, so another pass follows as soon as it is done."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            if self._running:
+                self._again = True
+            else:
+                self._schedule(0)
+
+    def overdue(self, now, multiple):
+        """Whether our next pass is more than multiple refreshes late."""
+        if self._event.is_set():
             return False
+        with self._lock:
+            if self._queued:
+                return False
+            since = max(self._due, self._pass)
+            return now - since > multiple * max(self._refresh, 1)
+
+    def expire(self):
+        """Give up on our overdue pass. See ServiceWatcher.expire()."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            late = time.time() - self._due
+            self._generation += 1
+            self._pass = None
+            self._running = False
+            self._again = False
+            for _, watcher in self._watchers:
+                watcher._force = True
+        self._release(self._slot)
+        for _, watcher in self._watchers:
+            self._engine.cancel(watcher)
+        self.log.error('No pass over the instances finished for %.1fs, '
+                       'restarting checks' % late)
+        metrics.inc('zk_watcher_watchdog_expired_total', service=self._service)
+        for _, watcher in self._watchers:
+            watcher._withdraw()
+        with self._lock:
+            if not self._event.is_set():
+                self._schedule(0)
+
+    def status(self):
+        """Returns the state of every instance, as a dict."""
+        return {
+            'running': self._running,
+            'interval': self._refresh,
+            'instances': dict((port, watcher.status())
+                              for port, watcher in self._watchers),
+        }
+
+    def stop(self):
+        """Stop checking, and de-register every instance."""
+        with self._lock:
+            self._event.set()
+            self._scheduler.cancel(self)
+        for _, watcher in self._watchers:
+            watcher.stop()
+
+    def diagnostics(self):
+        """Returns a summary of our instances, one line each."""
+        lines = ['%d instances, every %ss, lag %.3fs, running %s' % (
+            len(self._watchers), self._refresh, self._lag, self._running)]
+        for port, watcher in self._watchers:
+            lines.append('    [%s] %s' % (port, watcher.diagnostics()))
+        return '\n'.join(lines)
+
+    def _schedule(self, delay):
+        self._due = time.time() + delay
+        self._scheduler.schedule(self, delay, self._check)
+
+    def _next_delay(self):
+        refresh = max(self._refresh, 1)
+        delay = refresh - (time.time() - self._phase * refresh) % refresh
+        if self._jitter:
+            delay += random.uniform(0, self._jitter)
+        return delay
+
+    def _check(self):
+        """Checks every instance. Called from a Scheduler worker."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._running = True
+            self._queued = bool(self._admission)
+            start = functools.partial(self._start, self._generation)
+
+        if self._admission:
+            self._admission.submit(start, key=self)
+        else:
+            start()
+
+    def _start(self, generation):
+        with self._lock:
+            self._queued = False
+            if self._event.is_set() or generation != self._generation:
+                if generation == self._generation:
+                    self._running = False
+                if self._admission:
+                    self._admission.release()
+                return
+            started = time.time()
+            self._lag = max(started - self._due, 0)
+            metrics.observe('zk_watcher_schedule_lag_seconds', self._lag,
+                            service=self._service)
+            self._pass = started
+            self._slot = started
+            self._pending[started] = len(self._watchers)
+
+        commands = [watcher._command for _, watcher in self._watchers]
+        if all(isinstance(c, checks.Check) for c in commands):
+            try:
+                results = checks.run_all(commands)
+            except Exception, e:
+                self.log.error('Checks could not be run: %s', e)
+                results = [1] * len(commands)
+            for (_, watcher), ret in zip(self._watchers, results):
+                self._instance_done(watcher, started, ret)
+            return
+
+        # Engines may block the calling thread, so spread the instances
+        # over the workers.
+        for _, watcher in self._watchers:
+            self._scheduler.submit(functools.partial(
+                self._run_instance, watcher, started))
+
+    def _run_instance(self, watcher, started):
+        try:
+            self._engine.execute(
+                watcher._command, watcher._service, watcher._timeout,
+                functools.partial(self._instance_done, watcher, started),
+                output=watcher._data_filter is not None,
+                fresh=watcher._force, key=watcher)
+        except Exception, e:
+            self.log.error('[%s] could not be run: %s', watcher._command, e)
+            self._instance_done(watcher, started, 1)
+
+    def _instance_done(self, watcher, started, ret, output=None):
+        try:
+            if started == self._pass:
+                watcher.report(ret, started, output)
+        finally:
+            with self._lock:
+                self._pending[started] -= 1
+                done = self._pending[started] == 0
+                if done:
+                    del self._pending[started]
+                    if started == self._pass:
+                        self._running = False
+                        if not self._event.is_set():
+                            self._schedule(0 if self._again
+                                           else self._next_delay())
+                        self._again = False
+            if done:
+                self._release(started)
+
+    def _release(self, slot):
+        """Gives back our admission slot, if the pass slot still holds it."""
+        with self._lock:
+            if slot is None or slot != self._slot:
+                return
+            self._slot = None
+        if self._admission:
+            self._admission.release()
 
 
 class Command(object):
@@ -416,20 +1913,31 @@ class Command(object):
 
     LOGGER = 'WatcherDaemon.Command'
 
-    def __init__(self, cmd, service):
+    def __init__(self, cmd, service, limits=None):
         """Initialize the Command object.
 
         This object can be created once, and run many times. Each time it
         runs we initiate a small thread to run our process, and if that
-        process times out, we kill it."""
+        process times out, we kill it, along with anything it spawned: it
+        runs in a session (and process group) of its own. The process is
+        subject to limits (a limits.Limits object), if given."""
 
         self._cmd = cmd
+        self._service = service
+        self._limits = limits
         self._process = None
-        self.log = logging.getLogger('%s.%s' % (self.LOGGER, service))
+        self._cancelled = False
+        self.output = None
+        self.log = logpipe.per_service(
+            logging.getLogger('%s.%s' % (self.LOGGER, service)))
+
+    def run(self, timeout, output=False):
+        """Runs the command, and returns its exit code.
 
-    def run(self, timeout):
+        With output, the first MAX_OUTPUT bytes the command writes to stdout
+        are kept in self.output."""
         def target():
-            self.log.debug('[%s] started...' % self._cmd)
+            self.log.debug('[%s] started...', self._cmd)
             # Deliberately do not capture any output. Using PIPEs can
             # cause deadlocks according to the Python documentation here
             # (http://docs.python.org/library/subprocess.html)
@@ -439,44 +1947,150 @@ class Command(object):
             # a pipe such that it blocks waiting for the OS pipe buffer to
             # accept more # data. Use communicate() to avoid that."
             #
-            # We only care about the exit code of the command anyways...
+            # We usually only care about the exit code of the command
+            # anyways. When we do want its output, we read only as much as
+            # we need and throw away the rest, so that the command never
+            # blocks on a full pipe.
             try:
                 self._process = subprocess.Popen(
                     self._cmd.split(' '),
                     shell=False,
-                    stdout=open('/dev/null', 'w'),
+                    stdout=subprocess.PIPE if output else open('/dev/null', 'w'),
                     stderr=None,
-                    stdin=None)
+                    stdin=None,
+                    preexec_fn=self._preexec)
+                if self._cancelled:
+                    self._kill(signal.SIGKILL)
+                if output:
+                    stdout = self._process.stdout
+                    self.output = stdout.read(MAX_OUTPUT)
+                    while stdout.read(65536):
+                        pass
                 self._process.communicate()
-            except OSError, e:
-                self.log.warn('Failed to run: %s' % e)
+            except Exception, e:
+                # Whatever the preexec_fn raised in the child (eg. an
+                # IOError from Limits.apply()) is raised here again
+                self.log.warn('Failed to run: %s', e)
                 return 1
-            self.log.debug('[%s] finished... returning %s' %
-                          (self._cmd, self._process.returncode))
+            self.log.debug('[%s] finished... returning %s', self._cmd,
+                           self._process.returncode)
 
+        self._process = None
         thread = threading.Thread(target=target)
+        thread.setDaemon(True)
         thread.start()
 
         thread.join(timeout)
         if thread.is_alive():
-            self.log.debug('[%s] taking too long to respond, terminating.' %
+            self.log.debug('[%s] taking too long to respond, terminating.',
                            self._cmd)
-            try:
-                self._process.terminate()
-            except:
-                pass
-            thread.join()
+            metrics.inc('zk_watcher_check_timeouts_total',
+                        service=self._service)
+            self._kill(signal.SIGTERM)
+            thread.join(CHECK_KILL_GRACE)
+            if thread.is_alive():
+                self.log.debug('[%s] ignored SIGTERM, killing it.',
+                               self._cmd)
+                self._kill(signal.SIGKILL)
+                thread.join(CHECK_KILL_GRACE)
+            if thread.is_alive():
+                # Something outside of its process group holds on to its
+                # output; don't hold on to our worker as well
+                self.log.warning('[%s] could not be reaped, giving up on it',
+                                 self._cmd)
+                return 1
 
         # If the subprocess.Popen() fails for any reason, it returns 1... but
         # because its in a thread, we never actually see that error code.
-        if self._process:
+        if self._process and self._process.returncode is not None:
             return self._process.returncode
         else:
             return 1
 
+    def _preexec(self):
+        os.setsid()
+        if self._limits:
+            self._limits.apply()
+
+    def cancel(self):
+        """Kills the command (and whatever it spawned), if it is running.
+        run() then returns its exit code right away."""
+        self._cancelled = True
+        self._kill(signal.SIGKILL)
+
+    def _kill(self, sig):
+        """Sends sig to the process group of our command."""
+        try:
+            os.killpg(self._process.pid, sig)
+        except (AttributeError, OSError):
+            pass
+
 
-def setup_logger():
-    """Configure our main logger object"""
+class ThreadEngine(object):
+    """Runs each check with a Command in the calling worker thread."""
+
+    def __init__(self, limits=None):
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._running = {}
+        self._keys = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        """Kill the checks still running."""
+        with self._lock:
+            running = self._running.keys()
+        for check in running:
+            check.cancel()
+
+    def execute(self, command, service, timeout, callback, output=False,
+                key=None):
+        check = Command(command, service, self._limits)
+        with self._lock:
+            self._running[check] = time.time()
+            if key is not None:
+                self._keys[key] = check
+        try:
+            ret = check.run(timeout=timeout, output=output)
+        finally:
+            with self._lock:
+                del self._running[check]
+                if key is not None and self._keys.get(key) is check:
+                    del self._keys[key]
+        if output:
+            callback(ret, check.output or '')
+        else:
+            callback(ret)
+
+    def cancel(self, key):
+        """Kill the last check started with key, if it is still running.
+        The worker running it then gets on with its callback."""
+        with self._lock:
+            check = self._keys.pop(key, None)
+        if check:
+            check.cancel()
+
+    def in_flight(self):
+        """Returns the checks running right now, for diagnostics.
+
+        Returns:
+            A list of (service, command, pid, seconds running) tuples."""
+        now = time.time()
+        with self._lock:
+            running = self._running.items()
+        return [(check._service, check._cmd,
+                 check._process and check._process.pid, now - started)
+                for check, started in running]
+
+
+def setup_logger(verbose=False, syslog=False,
+                 repeat_window=LOG_REPEAT_WINDOW):
+    """Configure our main logger object
+
+    Records are written out by a LogWriter thread, so that a slow log never
+    holds up a check or an update of ZooKeeper (see logpipe.py)."""
     # Get our logger
     logger = logging.getLogger()
     pid = os.getpid()
@@ -484,30 +2098,60 @@ def setup_logger():
              '[%(funcName)s]: (%(levelname)s) %(message)s'
     formatter = logging.Formatter(format)
 
-    if options.verbose:
+    if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    if options.syslog:
+    if syslog:
         handler = logging.handlers.SysLogHandler('/dev/log', 'syslog')
     else:
         handler = logging.StreamHandler()
 
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    writer = logpipe.LogWriter(handler, window=repeat_window)
+    writer.start()
+    logger.addHandler(logpipe.QueueHandler(writer))
 
     return logger
 
 
 def main():
-    logger = setup_logger()
+    # First handle all of the options passed to us
+    (options, args) = parser.parse_args()
+    logger = setup_logger(verbose=options.verbose, syslog=options.syslog,
+                          repeat_window=options.log_repeat_window)
+
+    try:
+        limits = Limits(nice=options.check_nice,
+                        ionice=options.check_ionice,
+                        rlimit=options.check_rlimit,
+                        cgroup=options.check_cgroup)
+    except ValueError, e:
+        parser.error(str(e))
 
     # watcher？
     watcher = WatcherDaemon(
         config_file=options.config,
-        server=options.server,
-        verbose=options.verbose)
+        server=options.server or [ZOOKEEPER_URL],
+        verbose=options.verbose,
+        workers=options.workers,
+        engine=options.engine,
+        max_checks=options.max_checks,
+        reconcile=options.reconcile,
+        batch_window=options.batch_window,
+        jitter=options.jitter,
+        fast_start=options.fast_start,
+        state_file=options.state_file,
+        restore_grace=options.restore_grace,
+        dump_dir=options.dump_dir,
+        profile=options.profile,
+        limits=limits or None,
+        admin_socket=options.admin_socket,
+        watchdog=options.watchdog,
+        metrics_address=options.metrics,
+        config_dir=options.config_dir,
+        watch_config=options.watch_config)
 
     while True:
         try: